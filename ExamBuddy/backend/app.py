@@ -8,7 +8,6 @@ from flask_cors import CORS
 from flask_mail import Mail, Message
 from flask_login import LoginManager, UserMixin, login_user, current_user, logout_user
 from werkzeug.security import generate_password_hash, check_password_hash
-import dns.resolver
 
 import uuid
 from datetime import datetime 
@@ -16,20 +15,17 @@ from datetime import datetime
 from supabase import create_client, Client
 from dotenv import load_dotenv
 
-from rag_local import embed_local, search_faiss, ingest_single_file
-from langchain_groq import ChatGroq
+from rag_local import (
+    embed_query, search_hybrid, search_multi_query, build_context,
+    rag_stats, is_ready, start_background,
+    enqueue_ingest, ingest_status,
+)
+from notes_mapreduce import generate_notes_map_reduce, notes_progress
 from langchain_core.messages import HumanMessage, SystemMessage, AIMessage
 
 import io
-from reportlab.lib.pagesizes import A4
-from reportlab.pdfgen import canvas
-from reportlab.lib.colors import HexColor, grey, black
-
 from io import BytesIO
-from reportlab.pdfgen import canvas
-from reportlab.lib.pagesizes import A4
 from werkzeug.datastructures import FileStorage
-from tempfile import NamedTemporaryFile
 from markupsafe import escape
 
 from datetime import datetime, date, timedelta
@@ -56,6 +52,20 @@ app.config['MAIL_USERNAME'] = os.getenv('MAIL_USERNAME')
 app.config['MAIL_PASSWORD'] = os.getenv('MAIL_PASSWORD')
 mail = Mail(app)
 
+# Model warm-up and the ingest workers start with the first request served,
+# whatever launched the app (flask run, gunicorn, app.run with or without
+# the reloader; the reloader's watcher process never serves, so it never
+# starts them). The ingest workers write the FAISS index, so run a single
+# app process, or serve.py, which turns this off for its read-only HTTP
+# workers and drains the queue in its own writer process.
+app.config.setdefault("RAG_AUTOSTART", True)
+
+
+@app.before_request
+def start_rag_background():
+    if app.config["RAG_AUTOSTART"]:
+        start_background()
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 
@@ -134,6 +144,7 @@ def is_email_valid(email):
 
     domain = email.split('@')[1]
     try:
+        import dns.resolver
         records = dns.resolver.resolve(domain, 'MX')
         if not records:
             return False, "Email domain does not exist"
@@ -586,7 +597,7 @@ def summarize_thread_for_memory(messages, username: str) -> str:
             ),
             HumanMessage(content=prompt),
         ]
-        resp = llm.invoke(msgs)
+        resp = get_llm().invoke(msgs)
         text = resp.content if hasattr(resp, "content") else str(resp)
         return text.strip()
     except Exception as e:
@@ -623,6 +634,7 @@ def api_upload_docs():
     base_prefix = f"{root_type}/{username}/{title_norm}/"
 
     saved_paths = []
+    job_ids = []
 
     try:
         storage = supabase.storage.from_(STORAGE_BUCKET)
@@ -655,24 +667,50 @@ def api_upload_docs():
 
             saved_paths.append(key)
 
-            # ingest into embeddings
+            # ingest into embeddings in the background (see /api/ingest-status)
             try:
-                ingest_single_file(
-                    username=username,
-                    title=title_norm,
-                    path_in_bucket=key,
-                )
+                job_ids.append(enqueue_ingest(username, title_norm, key, data=file_bytes))
             except Exception as e:
-                print("INGEST ERROR for", key, ":", e)
+                print("INGEST ENQUEUE ERROR for", key, ":", e)
 
         if not saved_paths:
             return jsonify(success=False, msg="No valid files uploaded"), 400
 
-        return jsonify(success=True, paths=saved_paths)
+        return jsonify(success=True, paths=saved_paths, job_ids=job_ids)
     except Exception as e:
         print("UPLOAD DOCS ERROR:", e)
         return jsonify(success=False, msg=str(e)), 500
     
+@app.route("/api/ingest-status", methods=["GET"])
+def api_ingest_status():
+    """
+    Progress of the current user's ingest jobs: ?job_ids=a,b,c for specific
+    jobs, otherwise the most recent ones. stage is the last finished step
+    (queued / downloaded / partitioned / embedded / indexed).
+    """
+    if not current_user.is_authenticated:
+        return jsonify(success=False, msg="Not authenticated"), 401
+
+    username = normalize_username(current_user.username)
+    job_ids = [j.strip() for j in request.args.get("job_ids", "").split(",") if j.strip()]
+    return jsonify(success=True, jobs=ingest_status(username, job_ids or None))
+
+@app.route("/api/notes-progress", methods=["GET"])
+def api_notes_progress():
+    """
+    Progress of a map-reduce /api/generate-notes run (?run_id=...):
+    stage (collecting / map / reduce / done / failed), done of total groups,
+    and how many of those came from the cache.
+    """
+    if not current_user.is_authenticated:
+        return jsonify(success=False, msg="Not authenticated"), 401
+
+    username = normalize_username(current_user.username)
+    progress = notes_progress(username, request.args.get("run_id", "").strip())
+    if progress is None:
+        return jsonify(success=False, msg="Unknown run_id"), 404
+    return jsonify(success=True, progress=progress)
+
 @app.route("/api/list-root-folders", methods=["GET"])
 def api_list_root_folders():
     if not current_user.is_authenticated:
@@ -786,13 +824,46 @@ def api_file_url():
         return jsonify(success=False, hint='your pass')
 
 # ---------- Chat Bot ----------
-llm = ChatGroq(
-    groq_api_key=GROQ_API_KEY,
-    model_name="llama-3.1-8b-instant",
-    temperature=0.2,
-    max_tokens=4096,
-    timeout=60,
-)
+# Built on first use so importing app.py (and worker restarts) stay fast.
+_llm = None
+
+
+def get_llm():
+    global _llm
+    if _llm is None:
+        from langchain_groq import ChatGroq
+        _llm = ChatGroq(
+            groq_api_key=GROQ_API_KEY,
+            model_name="llama-3.1-8b-instant",
+            temperature=0.2,
+            max_tokens=4096,
+            timeout=60,
+        )
+    return _llm
+
+# Retrieval over-fetches; build_context keeps what fits the token budget.
+CHAT_CANDIDATES = 10
+CHAT_CONTEXT_TOKENS = 1200
+NOTES_CANDIDATES = 16
+NOTES_CONTEXT_TOKENS = 2500
+
+ROOT_TYPES = {"uploaded", "generated_notes", "generated_sample_papers"}
+
+
+def retrieval_filter_args(data: dict):
+    """
+    search_hybrid filter kwargs from a /chat or /api/generate-notes payload
+    (folder_title, doc_path, root_type; all optional). None if root_type
+    is not a known root.
+    """
+    root_type = (data.get("root_type") or "").strip() or None
+    if root_type and root_type not in ROOT_TYPES:
+        return None
+    return {
+        "folder_title": (data.get("folder_title") or "").strip() or None,
+        "doc_path": (data.get("doc_path") or "").strip() or None,
+        "root_type": root_type,
+    }
 
 SYSTEM_PROMPT = (
     "You are  PrepIQ, a helpful exam tutor.\n"
@@ -855,6 +926,9 @@ def chat():
         return jsonify({"reply": "Please enter a question."}), 400
     if not username:
         return jsonify({"reply": "Username is missing."}), 400
+    filters = retrieval_filter_args(data)
+    if filters is None:
+        return jsonify({"reply": "Invalid root_type."}), 400
 
     memory_summaries = []
     try:
@@ -899,25 +973,18 @@ def chat():
 
     # Your existing embed + retrieve logic (unchanged)
     try:
-        q_emb = embed_local([user_message])[0]
+        q_emb = embed_query(user_message)
     except Exception as e:
-        print("embed_local error:", e)
+        print("embed_query error:", e)
         return jsonify({"reply": "Error embedding your question."}), 500
 
     try:
-        results = search_faiss(username, None, q_emb, top_k=5)
+        results = search_hybrid(username, query=user_message, top_k=CHAT_CANDIDATES,
+                                query_embedding=q_emb, **filters)
+        context = build_context(results, q_emb, CHAT_CONTEXT_TOKENS)
     except Exception as e:
-        print("search_faiss error:", e)
-        results = []
-
-    context = ""
-    if results:
-        blocks = []
-        for r in results:
-            blocks.append(
-                f"[{r['folder_title']} / {r['section_title']}] {r['content']}"
-            )
-        context = "\n\n".join(blocks)
+        print("search_hybrid error:", e)
+        context = ""
 
     messages = [SystemMessage(content=SYSTEM_PROMPT)]
     if context:
@@ -960,7 +1027,7 @@ def chat():
 
     # Call Groq LLM
     try:
-        resp = llm.invoke(messages)
+        resp = get_llm().invoke(messages)
         answer = resp.content.strip()
     except Exception as e:
         print("Groq LLM error:", e)
@@ -968,6 +1035,21 @@ def chat():
  
     return jsonify({"reply": answer})
 
+@app.route("/api/rag-stats", methods=["GET"])
+def api_rag_stats():
+    return jsonify(success=True, **rag_stats())
+
+@app.route("/api/health", methods=["GET"])
+def api_health():
+    # liveness: answers while the embedding model is still loading
+    return jsonify(success=True, ready=is_ready())
+
+@app.route("/api/ready", methods=["GET"])
+def api_ready():
+    if not is_ready():
+        return jsonify(success=False, ready=False, msg="Warming up"), 503
+    return jsonify(success=True, ready=True)
+
 def get_user_id_by_username(username: str) -> str | None:
     if not username:
         return None
@@ -1092,9 +1174,18 @@ def api_generate_notes():
     note_format = (data.get("note_format") or "detailed").strip()
     custom_prompt = data.get("custom_prompt") or ""
     username = normalize_username(data.get("username") or "")
+    # "map_reduce" summarizes every chunk of the topic / folder in parallel
+    # instead of one prompt over the top chunks; the request stays open for
+    # the whole run (minutes, see notes_mapreduce), so poll
+    # /api/notes-progress with run_id meanwhile
+    generation_mode = (data.get("mode") or "single").strip()
+    run_id = (data.get("run_id") or "").strip() or str(uuid.uuid4())
 
     if not topic or not username:
         return jsonify(success=False, error="Missing topic or username"), 400
+    filters = retrieval_filter_args(data)
+    if filters is None:
+        return jsonify(success=False, error="Invalid root_type"), 400
 
     # ---------- 1) Build LLM prompt ----------
     base_instruction = build_format_instruction(note_format)
@@ -1107,34 +1198,43 @@ def api_generate_notes():
         f"Do not hallucinate content that is not present or implied in the uploaded notes."
     )
 
-    # ---------- 2) RAG retrieval ----------
-    try:
-        q_emb = embed_local([user_prompt])[0]
-        results = search_faiss(username, None, q_emb, top_k=8)
-    except Exception as e:
-        print("RAG error:", e)
-        results = []
+    queries = build_notes_queries(topic, note_format, custom_prompt)
 
-    context_blocks = []
-    for r in results or []:
-        context_blocks.append(
-            f"[{r['folder_title']} / {r['section_title']}] {r['content']}"
-        )
-    context = "\n\n".join(context_blocks)
+    if generation_mode == "map_reduce":
+        # ---------- 2+3) Map-reduce over all of the topic's chunks ----------
+        try:
+            raw_notes, run_id = generate_notes_map_reduce(
+                get_llm(), username, topic, queries, SYSTEM_PROMPT, user_prompt,
+                run_id=run_id, **filters,
+            )
+        except Exception as e:
+            print("LLM map-reduce error:", e)
+            return jsonify(success=False, error="LLM failed", run_id=run_id), 500
+    else:
+        # ---------- 2) RAG retrieval ----------
+        try:
+            # focused sub-queries (not the templated prompt) in one batched search;
+            # BM25 matches the topic's exact terms
+            results = search_multi_query(username, queries, top_k=NOTES_CANDIDATES,
+                                         lexical_query=topic, **filters)
+            context = build_context(results, None, NOTES_CONTEXT_TOKENS)
+        except Exception as e:
+            print("RAG error:", e)
+            context = ""
 
-    messages = [
-        SystemMessage(content=SYSTEM_PROMPT),
-        SystemMessage(content=f"Context (user uploaded notes only):\n{context}"),
-        HumanMessage(content=user_prompt),
-    ]
+        messages = [
+            SystemMessage(content=SYSTEM_PROMPT),
+            SystemMessage(content=f"Context (user uploaded notes only):\n{context}"),
+            HumanMessage(content=user_prompt),
+        ]
 
-    # ---------- 3) Call LLM ----------
-    try:
-        resp = llm.invoke(messages)
-        raw_notes = resp.content.strip()
-    except Exception as e:
-        print("LLM error:", e)
-        return jsonify(success=False, error="LLM failed"), 500
+        # ---------- 3) Call LLM ----------
+        try:
+            resp = get_llm().invoke(messages)
+            raw_notes = resp.content.strip()
+        except Exception as e:
+            print("LLM error:", e)
+            return jsonify(success=False, error="LLM failed"), 500
 
     if not raw_notes:
         return jsonify(success=False, error="Empty notes"), 500
@@ -1143,12 +1243,8 @@ def api_generate_notes():
     pdf_bytes = notes_to_pdf_bytes(topic, note_format, raw_notes)
 
     # ---------- 5) Upload PDF using existing upload flow ----------
-    tmp = NamedTemporaryFile(delete=False, suffix=".pdf")
-    tmp.write(pdf_bytes)
-    tmp.flush()
-
     pdf_file = FileStorage(
-        stream=open(tmp.name, "rb"),
+        stream=BytesIO(pdf_bytes),
         filename=f"{topic.replace(' ', '_')}_{note_format}.pdf",
         content_type="application/pdf",
     )
@@ -1170,6 +1266,7 @@ def api_generate_notes():
     success=True,
     notes=raw_notes,
     pdf_paths=paths,
+    run_id=run_id,
     )
 
 def build_format_instruction(fmt: str) -> str:
@@ -1188,6 +1285,39 @@ def build_format_instruction(fmt: str) -> str:
     }
     return mapping.get(fmt, mapping["detailed"])
 
+# Aspects of a topic searched separately so notes cover more than the
+# chunks closest to the topic name alone.
+NOTES_QUERY_FACETS = (
+    "definition and overview",
+    "key concepts and principles",
+    "examples and applications",
+    "advantages, limitations and comparisons",
+)
+NOTES_FORMAT_FACETS = {
+    "cheatsheet": "formulas and important facts",
+    "keywords": "important terms and definitions",
+    "differentiation": "differences between related concepts",
+    "diagrams": "diagram, architecture and labeled parts",
+    "qa": "questions and answers",
+    "pyqs": "exam questions and solutions",
+    "practice_papers": "exam questions and solutions",
+}
+
+
+def build_notes_queries(topic: str, fmt: str, custom_prompt: str = "") -> list:
+    """Search queries for notes retrieval, derived from the topic without an LLM call."""
+    queries = [topic]
+    # "TCP, UDP and QUIC" -> each subtopic on its own as well
+    parts = [p.strip() for p in re.split(r",|;|/|\band\b|&", topic) if p.strip()]
+    if len(parts) > 1:
+        queries.extend(parts)
+    queries.extend(f"{topic} {facet}" for facet in NOTES_QUERY_FACETS)
+    if fmt in NOTES_FORMAT_FACETS:
+        queries.append(f"{topic} {NOTES_FORMAT_FACETS[fmt]}")
+    if custom_prompt.strip() and len(custom_prompt) <= 300:
+        queries.append(f"{topic} {custom_prompt.strip()}")
+    return queries
+
 def render_notes_html(topic, fmt, body_text):
     # body_text is Markdown-like or plain text; you can keep it simple
     safe_topic = escape(topic)
@@ -1214,6 +1344,9 @@ def render_notes_html(topic, fmt, body_text):
     """
 
 def notes_to_pdf_bytes(topic: str, note_format: str, notes: str) -> bytes:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
     buf = BytesIO()
     c = canvas.Canvas(buf, pagesize=A4)
     width, height = A4
@@ -1288,13 +1421,9 @@ def upload_generated_file_to_supabase(root_type: str, username: str, title: str,
     saved_paths.append(key)
 
     try:
-        ingest_single_file(
-            username=username_norm,
-            title=title_norm,
-            path_in_bucket=key,
-        )
+        enqueue_ingest(username_norm, title_norm, key, data=file_bytes)
     except Exception as e:
-        print("INGEST ERROR for", key, ":", e)
+        print("INGEST ENQUEUE ERROR for", key, ":", e)
 
     return saved_paths
 
@@ -1371,7 +1500,7 @@ def call_llm_for_mindmap(topic: str, extra: str) -> dict:
     prompt = build_mindmap_prompt(topic, extra)
     
     try:
-        resp = llm.invoke(prompt)
+        resp = get_llm().invoke(prompt)
         raw_response = resp.content.strip()
         
         print(f"[MINDMAP] Raw LLM response:{raw_response}")
@@ -1396,11 +1525,13 @@ def call_llm_for_mindmap(topic: str, extra: str) -> dict:
         print(f"[MINDMAP] Using fallback tree: {json.dumps(fallback, indent=2)}")
         return fallback
 
-def draw_node(c: canvas.Canvas, node: dict, x: float, y: float,
+def draw_node(c: "canvas.Canvas", node: dict, x: float, y: float,
               indent: float, line_height: float = 18, max_width: float = 500) -> float:
     """
     Recursively draw mind map nodes on PDF canvas.
     """
+    from reportlab.lib.pagesizes import A4
+
     label = str(node.get("label", "Untitled"))
     
     # Wrap long labels
@@ -1429,7 +1560,7 @@ def draw_node(c: canvas.Canvas, node: dict, x: float, y: float,
         # Page break if needed
         if y < 60:
             c.showPage()
-            y = A4 - 50
+            y = A4[1] - 50
             c.setFont("Helvetica", 10)
         
         y = draw_node(c, child, x, y, indent + 20, line_height, max_width)
@@ -1437,6 +1568,10 @@ def draw_node(c: canvas.Canvas, node: dict, x: float, y: float,
     return y
 
 def generate_mindmap_pdf_bytes(topic: str, mindmap: dict) -> bytes:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+    from reportlab.lib.colors import HexColor, grey, black
+
     buf = io.BytesIO()
     c = canvas.Canvas(buf, pagesize=A4)
     width, height = A4
@@ -1719,7 +1854,6 @@ def get_news():
 # browser_routes.py
 from flask import Blueprint, request, jsonify
 import requests
-from bs4 import BeautifulSoup
 
 browser_bp = Blueprint("browser", __name__, url_prefix="/api/browser")
 
@@ -1738,6 +1872,8 @@ def scrape():
     url = data.get("url")
     if not url:
         return jsonify({"error": "url required"}), 400
+    from bs4 import BeautifulSoup
+
     resp = requests.get(url, timeout=5)
     soup = BeautifulSoup(resp.text, "html.parser")
     text = soup.get_text(separator="\n")[:4000]
@@ -0,0 +1,54 @@
+import sys
+import time
+
+import numpy as np
+
+from rag_local import load_embed_model, chunk_store
+
+# ====== Embedding backend check + CPU throughput ======
+# Compares onnx / onnx-int8 against the PyTorch sentence-transformers
+# output on real chunks from the metadata store. A backend passes when
+# every text's cosine similarity to the PyTorch vector is >= MIN_COSINE.
+MIN_COSINE = 0.99
+BACKENDS = ["torch", "onnx", "onnx-int8"]
+
+FALLBACK_TEXTS = [
+    "Cloud computing delivers on-demand compute, storage and networking over the internet.",
+    "A SQL injection attack inserts malicious queries through unsanitized input fields.",
+    "Newton's second law states that force equals mass times acceleration.",
+    "Photosynthesis converts light energy into chemical energy stored in glucose.",
+]
+
+
+def timed_encode(model, texts, batch_size):
+    model.encode(texts[:batch_size], batch_size=batch_size)  # warm-up
+    t0 = time.perf_counter()
+    vecs = model.encode(texts, batch_size=batch_size, show_progress_bar=False, convert_to_numpy=True)
+    return np.asarray(vecs, dtype="float32"), time.perf_counter() - t0
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    texts = chunk_store.sample_contents(n) or FALLBACK_TEXTS * (n // len(FALLBACK_TEXTS))
+    print(f"Texts: {len(texts)}  batch_size: {batch_size}")
+
+    reference = None
+    print(f"\n{'backend':<10} {'texts/s':>9} {'min cos':>8} {'mean cos':>9}  result")
+    for backend in BACKENDS:
+        try:
+            model = load_embed_model(backend)
+        except Exception as e:
+            print(f"{backend:<10} skipped: {e}")
+            continue
+        vecs, secs = timed_encode(model, texts, batch_size)
+        vecs /= np.linalg.norm(vecs, axis=1, keepdims=True)
+        if reference is None:
+            reference = vecs
+        cos = (vecs * reference).sum(axis=1)
+        verdict = "PASS" if cos.min() >= MIN_COSINE else "FAIL"
+        print(f"{backend:<10} {len(texts) / secs:>9.1f} {cos.min():>8.4f} {cos.mean():>9.4f}  {verdict}")
+
+
+if __name__ == "__main__":
+    main()
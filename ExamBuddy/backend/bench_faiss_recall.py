@@ -0,0 +1,72 @@
+import sys
+import time
+
+import numpy as np
+import faiss
+
+from rag_local import (
+    FAISS_INDEX_FACTORIES, chunk_store, index_manager,
+    build_faiss_index, faiss_search_params,
+)
+
+# ====== Recall / memory comparison of FAISS index types ======
+# Loads the real vectors of the given users (default: everyone in the
+# metadata store), builds every index type in FAISS_INDEX_FACTORIES over
+# them and compares against exact Flat search.
+NUM_QUERIES = 200
+
+
+def load_corpus(usernames):
+    all_ids, all_vecs = [], []
+    for username in usernames:
+        kind, ids, vecs = index_manager.partition(username).export_vectors()
+        if kind != "flat":
+            print(f"⚠️ {username} is stored as {kind}; 'exact' baseline is its decoded vectors")
+        all_ids.append(ids)
+        all_vecs.append(vecs)
+    return np.concatenate(all_ids), np.concatenate(all_vecs).astype("float32")
+
+
+def recall_at_k(truth, found, k):
+    hits = 0
+    for t, f in zip(truth, found):
+        hits += len(set(t[:k].tolist()) & set(f[:k].tolist()))
+    return hits / (len(truth) * k)
+
+
+def main():
+    k = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    usernames = sys.argv[2:] or chunk_store.usernames()
+    if not usernames:
+        print("No users in the metadata store.")
+        return
+
+    ids, vectors = load_corpus(usernames)
+    n = len(ids)
+    print(f"Corpus: {n} vectors from {len(usernames)} user(s); k={k}")
+
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(n, size=min(NUM_QUERIES, n), replace=False)]
+    # perturb so queries are near, not identical to, stored chunks
+    queries = queries + rng.normal(scale=0.02, size=queries.shape).astype("float32")
+    faiss.normalize_L2(queries)
+
+    exact = build_faiss_index("flat", ids, vectors)
+    _, truth = exact.search(queries, k)
+
+    print(f"\n{'type':<10} {'bytes/vec':>10} {'size MB':>9} {'recall@k':>9} {'ms/query':>9}")
+    for kind in FAISS_INDEX_FACTORIES:
+        try:
+            index = build_faiss_index(kind, ids, vectors)
+        except Exception as e:
+            print(f"{kind:<10} skipped: {e}")
+            continue
+        size = faiss.serialize_index(index).nbytes
+        t0 = time.perf_counter()
+        _, found = index.search(queries, k, params=faiss_search_params(index))
+        ms = (time.perf_counter() - t0) * 1000 / len(queries)
+        print(f"{kind:<10} {size / n:>10.0f} {size / 1e6:>9.2f} {recall_at_k(truth, found, k):>9.3f} {ms:>9.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+# backend/chunker.py
+
+import os
+
+# -------------------------
+# Token-aware chunking
+# -------------------------
+# Sections (text between two Title elements) are cut into windows of at
+# most CHUNK_MAX_TOKENS embedding-tokenizer tokens, consecutive windows
+# sharing CHUNK_OVERLAP_TOKENS. all-MiniLM-L6-v2 truncates at 256
+# word-pieces, so this keeps every chunk fully embedded and bounds how much
+# text a single hit adds to an LLM prompt.
+CHUNK_MAX_TOKENS = int(os.getenv("CHUNK_MAX_TOKENS", "200"))
+CHUNK_OVERLAP_TOKENS = int(os.getenv("CHUNK_OVERLAP_TOKENS", "40"))
+
+
+def _token_offsets(tokenizer, text: str):
+    """[(start, end)] char span of every token (no special tokens)."""
+    if tokenizer is not None:
+        try:
+            enc = tokenizer(text, add_special_tokens=False, return_offsets_mapping=True)
+            return [tuple(o) for o in enc["offset_mapping"]]
+        except NotImplementedError:
+            pass  # slow (pure Python) tokenizer: no offsets
+    # fallback: whitespace words stand in for tokens
+    offsets, pos = [], 0
+    for word in text.split():
+        start = text.index(word, pos)
+        pos = start + len(word)
+        offsets.append((start, pos))
+    return offsets
+
+
+def count_tokens(tokenizer, text: str) -> int:
+    return len(_token_offsets(tokenizer, text))
+
+
+def split_text(text: str, tokenizer, max_tokens: int = CHUNK_MAX_TOKENS,
+               overlap: int = CHUNK_OVERLAP_TOKENS):
+    """
+    Split text into [(piece, n_tokens)] with at most max_tokens tokens each.
+    A window ends at the last line break in its second half when there is
+    one, so pieces tend to stop between paragraphs rather than mid-sentence.
+    """
+    offsets = _token_offsets(tokenizer, text)
+    n = len(offsets)
+    if n <= max_tokens:
+        return [(text.strip(), n)] if n else []
+
+    overlap = min(overlap, max_tokens // 2)
+    pieces = []
+    start = 0
+    while start < n:
+        end = min(start + max_tokens, n)
+        if end < n:
+            for i in range(end - 1, start + max_tokens // 2, -1):
+                if "\n" in text[offsets[i - 1][1]:offsets[i][0]]:
+                    end = i
+                    break
+        pieces.append((text[offsets[start][0]:offsets[end - 1][1]].strip(), end - start))
+        if end == n:
+            break
+        start = end - overlap
+        # don't open the next piece on a word-piece continuation
+        while start < end and offsets[start][0] == offsets[start - 1][1]:
+            start += 1
+    return pieces
+
+
+def chunk_sections(sections, tokenizer, max_tokens: int = CHUNK_MAX_TOKENS,
+                   overlap: int = CHUNK_OVERLAP_TOKENS):
+    """
+    sections: [(title, text)] in document order.
+    Returns [{"title", "content", "token_count"}]; a long section becomes
+    several chunks that all carry its title.
+    """
+    chunks = []
+    for title, text in sections:
+        for piece, n_tokens in split_text(text, tokenizer, max_tokens, overlap):
+            if piece:
+                chunks.append({"title": title, "content": piece, "token_count": n_tokens})
+    return chunks
@@ -0,0 +1,127 @@
+# backend/context_pack.py
+
+import os
+import hashlib
+import threading
+
+import numpy as np
+
+from chunker import count_tokens
+
+# -------------------------
+# Context packing for LLM prompts
+# -------------------------
+# Retrieved hits are turned into the "Context:" block of a prompt here
+# instead of joining every hit blindly:
+#   1. near-identical chunks (re-uploads, overlapping windows) are dropped,
+#      keeping the higher-ranked copy
+#   2. the rest are ordered by maximal marginal relevance, so a chunk that
+#      repeats what is already selected loses to one that adds something
+#   3. chunks are packed until the token budget is spent
+# Tokens are counted with the embedding tokenizer, a close enough proxy for
+# the LLM's own.
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", "0.7"))  # 1.0 = relevance only
+CONTEXT_DUP_SIMILARITY = 0.95  # cosine at or above this = same chunk
+
+_stats_lock = threading.Lock()
+_stats = {"requests": 0, "candidates": 0, "duplicates": 0, "selected": 0,
+          "tokens_in": 0, "tokens_used": 0}
+
+
+def format_hit(hit) -> str:
+    return f"[{hit.get('folder_title')} / {hit.get('section_title')}] {hit['content']}"
+
+
+def _text_key(text: str) -> str:
+    return hashlib.sha1(" ".join(text.lower().split()).encode("utf-8")).hexdigest()
+
+
+def _unit_rows(vectors):
+    vectors = np.asarray(vectors, dtype="float32")
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def pack_context(hits, query_embedding, vectors, tokenizer,
+                 token_budget: int = CONTEXT_TOKEN_BUDGET,
+                 mmr_lambda: float = CONTEXT_MMR_LAMBDA):
+    """
+    hits: retrieval results, best first.
+    vectors: (n, d) vectors of the hits' content, aligned with hits; an
+    all-zero row (vector unknown) is never treated as a duplicate.
+    query_embedding: (d,) or None (relevance then follows hit order).
+    Returns (context, report); report counts what was dropped and
+    tokens_saved versus joining every hit.
+    """
+    blocks = [format_hit(h) for h in hits]
+    sizes = [count_tokens(tokenizer, b) for b in blocks]
+    report = {"candidates": len(hits), "duplicates": 0, "selected": 0,
+              "tokens_in": sum(sizes), "tokens_used": 0}
+    if not hits:
+        report["tokens_saved"] = 0
+        return "", report
+
+    # 1) exact duplicates (after case/whitespace folding), then near-duplicates
+    seen = set()
+    keep = []
+    for i, h in enumerate(hits):
+        key = _text_key(h["content"])
+        if key not in seen:
+            seen.add(key)
+            keep.append(i)
+
+    vecs = _unit_rows(np.asarray(vectors)[keep])
+    sim = vecs @ vecs.T
+    unique = []
+    for j in range(len(keep)):
+        if all(sim[j, u] < CONTEXT_DUP_SIMILARITY for u in unique):
+            unique.append(j)
+    report["duplicates"] = len(hits) - len(unique)
+
+    # 2) relevance: cosine to the query, or rank when there's no query vector
+    if query_embedding is not None:
+        rel = vecs[unique] @ _unit_rows(query_embedding).reshape(-1)
+    else:
+        rel = 1.0 - np.arange(len(unique)) / max(len(unique), 1)
+
+    # 3) greedy MMR, packing whatever still fits the budget
+    remaining = list(range(len(unique)))
+    redundancy = np.full(len(unique), -1.0, dtype="float32")
+    chosen = []
+    used = 0
+    while remaining:
+        scores = [mmr_lambda * rel[r] - (1.0 - mmr_lambda) * max(redundancy[r], 0.0)
+                  for r in remaining]
+        r = remaining.pop(int(np.argmax(scores)))
+        hit_idx = keep[unique[r]]
+        if used + sizes[hit_idx] > token_budget:
+            continue  # too big for what's left; a smaller chunk may still fit
+        chosen.append(hit_idx)
+        used += sizes[hit_idx]
+        redundancy = np.maximum(redundancy, sim[unique, unique[r]])
+
+    report["selected"] = len(chosen)
+    report["tokens_used"] = used
+    report["tokens_saved"] = report["tokens_in"] - used
+
+    with _stats_lock:
+        _stats["requests"] += 1
+        for k in ("candidates", "duplicates", "selected", "tokens_in", "tokens_used"):
+            _stats[k] += report[k]
+
+    print(
+        f"✅ pack_context: {len(chosen)}/{len(hits)} chunks "
+        f"({report['duplicates']} duplicates), {used}/{token_budget} tokens, "
+        f"{report['tokens_saved']} saved"
+    )
+    return "\n\n".join(blocks[i] for i in chosen), report
+
+
+def context_stats():
+    """Running totals (served through rag_stats)."""
+    with _stats_lock:
+        st = dict(_stats)
+    st["tokens_saved"] = st["tokens_in"] - st["tokens_used"]
+    st["avg_tokens_saved"] = round(st["tokens_saved"] / st["requests"], 1) if st["requests"] else 0.0
+    return st
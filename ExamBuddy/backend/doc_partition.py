@@ -0,0 +1,193 @@
+# backend/doc_partition.py
+
+import os
+import time
+import tempfile
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# -------------------------
+# Parallel document partitioning
+# -------------------------
+# unstructured's partition() is CPU-bound and holds the GIL, so it runs in
+# a bounded process pool shared by every ingest worker. Large PDFs are cut
+# into page ranges that are partitioned in parallel and merged back in
+# page order. Pool processes are spawned (not forked) so they never inherit
+# the server's threads or model state.
+#
+# PDF pages are probed with pypdf first: pages with a text layer use
+# unstructured's "fast" strategy, and only pages without one (scans) go
+# through the layout/OCR models.
+PARTITION_PROCESSES = int(os.getenv("PARTITION_PROCESSES", str(os.cpu_count() or 1)))
+PDF_PAGES_PER_RANGE = int(os.getenv("PDF_PAGES_PER_RANGE", "20"))
+PDF_SPLIT_MIN_PAGES = 2 * PDF_PAGES_PER_RANGE  # smaller all-text PDFs go through whole
+PDF_TEXT_MIN_CHARS = 25  # less extractable text than this = scanned page
+PDF_TEXT_STRATEGY = "fast"
+PDF_SCANNED_STRATEGY = os.getenv("PDF_SCANNED_STRATEGY", "hi_res")  # or "ocr_only"
+
+_pool = None
+_pool_lock = threading.Lock()
+
+_stats_lock = threading.Lock()
+_strategy_stats = {}  # strategy -> {"calls", "pages", "seconds"}
+
+
+def _record(strategy: str, pages: int, seconds: float):
+    with _stats_lock:
+        st = _strategy_stats.setdefault(strategy, {"calls": 0, "pages": 0, "seconds": 0.0})
+        st["calls"] += 1
+        st["pages"] += pages
+        st["seconds"] += seconds
+
+
+def partition_stats():
+    """Per-strategy partition timings (served through rag_stats)."""
+    with _stats_lock:
+        return {
+            strategy: {
+                **st,
+                "seconds": round(st["seconds"], 3),
+                "ms_per_page": round(st["seconds"] * 1000 / st["pages"], 1) if st["pages"] else 0.0,
+            }
+            for strategy, st in _strategy_stats.items()
+        }
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=PARTITION_PROCESSES,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            print(f"🚀 Started partition pool with {PARTITION_PROCESSES} processes")
+        return _pool
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+
+
+def probe_pdf_text(local_path: str):
+    """
+    [has text layer] per page, or None when it isn't a readable PDF
+    (or pypdf is missing).
+    """
+    if not local_path.lower().endswith(".pdf"):
+        return None
+    started = time.perf_counter()
+    try:
+        from pypdf import PdfReader
+        reader = PdfReader(local_path)
+        has_text = []
+        for page in reader.pages:
+            try:
+                txt = page.extract_text() or ""
+            except Exception:
+                txt = ""
+            has_text.append(len(txt.strip()) >= PDF_TEXT_MIN_CHARS)
+    except Exception as e:
+        print("⚠️ Could not probe PDF text layer, partitioning whole file:", e)
+        return None
+    _record("probe", len(has_text), time.perf_counter() - started)
+    return has_text
+
+
+def page_ranges(has_text, per_range: int = PDF_PAGES_PER_RANGE):
+    """
+    [(first, last, strategy)] 0-based inclusive runs of pages that share a
+    strategy, each at most per_range pages long.
+    """
+    ranges = []
+    start = 0
+    for i in range(1, len(has_text) + 1):
+        if i == len(has_text) or has_text[i] != has_text[start] or i - start == per_range:
+            strategy = PDF_TEXT_STRATEGY if has_text[start] else PDF_SCANNED_STRATEGY
+            ranges.append((start, i - 1, strategy))
+            start = i
+    return ranges
+
+
+def _write_page_range(local_path: str, first: int, last: int) -> str:
+    from pypdf import PdfReader, PdfWriter
+
+    reader = PdfReader(local_path)
+    writer = PdfWriter()
+    for i in range(first, last + 1):
+        writer.add_page(reader.pages[i])
+    fd, out_path = tempfile.mkstemp(suffix=".pdf")
+    with os.fdopen(fd, "wb") as f:
+        writer.write(f)
+    return out_path
+
+
+def partition_file(local_path: str, page_range=None, strategy=None):
+    """
+    Partition a file (or pages first..last of a PDF) with unstructured,
+    using strategy when given. Returns ([(category, text)], seconds) so
+    results cross process boundaries cheaply.
+    """
+    from unstructured.partition.auto import partition
+
+    started = time.perf_counter()
+    target = local_path
+    if page_range is not None:
+        target = _write_page_range(local_path, *page_range)
+    try:
+        if strategy:
+            elements = partition(filename=target, strategy=strategy)
+        else:
+            elements = partition(filename=target)
+    finally:
+        if target != local_path:
+            os.remove(target)
+    elements = [
+        (getattr(el, "category", None), str(getattr(el, "text", "") or ""))
+        for el in elements
+    ]
+    return elements, time.perf_counter() - started
+
+
+def partition_document(local_path: str):
+    """
+    [(category, text)] for the whole document, in reading order.
+    Runs in the process pool; PDFs fan out over page ranges grouped by
+    whether the pages have a text layer.
+    """
+    has_text = probe_pdf_text(local_path)
+    if not has_text:
+        jobs = [(None, None, 1)]  # not a PDF: let unstructured pick
+    else:
+        scanned = has_text.count(False)
+        if scanned:
+            print(f"ℹ️ {scanned}/{len(has_text)} pages have no text layer -> {PDF_SCANNED_STRATEGY}")
+        if not scanned and len(has_text) < PDF_SPLIT_MIN_PAGES:
+            jobs = [(None, PDF_TEXT_STRATEGY, len(has_text))]
+        else:
+            jobs = [((first, last), strategy, last - first + 1)
+                    for first, last, strategy in page_ranges(has_text)]
+
+    if PARTITION_PROCESSES <= 1:
+        parts = [partition_file(local_path, r, strategy) for r, strategy, _ in jobs]
+    else:
+        if len(jobs) > 1:
+            print(f"➡️ Partitioning {len(has_text)} pages as {len(jobs)} parallel ranges")
+        try:
+            pool = _get_pool()
+            futures = [pool.submit(partition_file, local_path, r, strategy) for r, strategy, _ in jobs]
+            parts = [f.result() for f in futures]
+        except BrokenProcessPool:
+            # a worker died (OOM, segfault in a parser); start fresh next time
+            _reset_pool()
+            raise
+
+    for (_, strategy, pages), (_, seconds) in zip(jobs, parts):
+        _record(strategy or "auto", pages, seconds)
+    return [el for elements, _ in parts for el in elements]
@@ -0,0 +1,105 @@
+# backend/embed_cache.py
+
+import os
+import time
+import hashlib
+import sqlite3
+import threading
+
+import numpy as np
+
+# -------------------------
+# Persistent embedding cache
+# -------------------------
+# (model, sha256(chunk text)) -> vector, so re-ingesting an unchanged
+# document (re-upload, same PDF in two folders, rename) skips the model.
+EMBED_CACHE_DB_PATH = os.path.join("faiss_store", "embed_cache.sqlite")
+EMBED_CACHE_MAX_ROWS = 100_000  # ~150 MB of 384-dim float32 vectors
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS embeddings (
+    key       TEXT PRIMARY KEY,
+    vector    BLOB NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_embeddings_last_used ON embeddings(last_used);
+"""
+
+
+def _cache_key(model: str, text: str) -> str:
+    return model + ":" + hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    SQLite-backed (model, text hash) -> float32 vector cache.
+    Least-recently-used rows are evicted once it exceeds max_rows.
+    """
+
+    def __init__(self, db_path: str = EMBED_CACHE_DB_PATH, max_rows: int = EMBED_CACHE_MAX_ROWS):
+        self.db_path = db_path
+        self.max_rows = max_rows
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._conn().executescript(_SCHEMA)
+        if hasattr(os, "register_at_fork"):
+            # a SQLite connection must not be used across fork (serve.py)
+            os.register_at_fork(after_in_child=self._drop_connections)
+
+    def _drop_connections(self):
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, model: str, texts):
+        """Returns {position in texts: vector} for the cached texts."""
+        keys = [_cache_key(model, t) for t in texts]
+        found = {}
+        conn = self._conn()
+        # stay well under SQLite's bound-parameter limit
+        for start in range(0, len(keys), 500):
+            batch = keys[start:start + 500]
+            marks = ",".join("?" * len(batch))
+            for key, blob in conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({marks})", batch
+            ):
+                found[key] = np.frombuffer(blob, dtype="float32")
+
+        if found:
+            with self._write_lock, conn:
+                conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                    [(time.time(), k) for k in found],
+                )
+        return {i: found[k] for i, k in enumerate(keys) if k in found}
+
+    def put_many(self, model: str, texts, vectors):
+        now = time.time()
+        rows = [
+            (_cache_key(model, t), np.asarray(v, dtype="float32").tobytes(), now)
+            for t, v in zip(texts, vectors)
+        ]
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                conn.executemany(
+                    "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+                    rows,
+                )
+                excess = conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] - self.max_rows
+                if excess > 0:
+                    conn.execute(
+                        "DELETE FROM embeddings WHERE key IN "
+                        "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                        (excess,),
+                    )
+                    print(f"ℹ️ embed cache: evicted {excess} least-recently-used vectors")
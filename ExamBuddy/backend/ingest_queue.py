@@ -0,0 +1,255 @@
+# backend/ingest_queue.py
+
+import os
+import time
+import uuid
+import sqlite3
+import threading
+
+# -------------------------
+# Persistent ingestion job queue
+# -------------------------
+# Uploads enqueue one job per file and return right away; background
+# workers (IngestWorkers) run the pipeline and record each stage, so
+# /api/ingest-status can report progress and a restart resumes the queue.
+INGEST_QUEUE_DB_PATH = os.path.join("faiss_store", "ingest_jobs.sqlite")
+INGEST_SPOOL_DIR = os.path.join("faiss_store", "ingest_spool")  # uploaded bytes awaiting ingest
+INGEST_JOB_RETENTION_S = 7 * 24 * 3600  # finished jobs are kept this long
+INGEST_POLL_S = 2.0                     # idle workers re-check the queue this often
+
+# stages, in pipeline order
+INGEST_STAGES = ("queued", "downloaded", "partitioned", "embedded", "indexed")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ingest_jobs (
+    id             TEXT PRIMARY KEY,
+    username       TEXT NOT NULL,
+    title          TEXT,
+    path_in_bucket TEXT NOT NULL,
+    local_path     TEXT,            -- spooled upload, deleted once the job ends
+    status         TEXT NOT NULL,   -- queued | running | done | failed
+    stage          TEXT NOT NULL,   -- last completed entry of INGEST_STAGES
+    error          TEXT,
+    attempts       INTEGER NOT NULL DEFAULT 0,
+    created_at     REAL NOT NULL,
+    updated_at     REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_ingest_jobs_status ON ingest_jobs(status, created_at);
+CREATE INDEX IF NOT EXISTS idx_ingest_jobs_username ON ingest_jobs(username, created_at);
+"""
+
+_COLUMNS = ("id", "username", "title", "path_in_bucket", "local_path", "status",
+            "stage", "error", "attempts", "created_at", "updated_at")
+
+
+class IngestQueue:
+    """
+    SQLite-backed FIFO of ingestion jobs. Safe to share between threads
+    and processes: claim() only hands a queued job to one caller.
+    """
+
+    def __init__(self, db_path: str = INGEST_QUEUE_DB_PATH, spool_dir: str = INGEST_SPOOL_DIR):
+        self.db_path = db_path
+        self.spool_dir = spool_dir
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(ingest_jobs)")}
+        if "local_path" not in cols:  # queues created before upload spooling
+            conn.execute("ALTER TABLE ingest_jobs ADD COLUMN local_path TEXT")
+        self.wakeup = threading.Event()  # set by enqueue() for same-process workers
+        if hasattr(os, "register_at_fork"):
+            # a SQLite connection must not be used across fork (serve.py)
+            os.register_at_fork(after_in_child=self._drop_connections)
+
+    def _drop_connections(self):
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def _update(self, job_id: str, **fields):
+        fields["updated_at"] = time.time()
+        sets = ", ".join(f"{k} = ?" for k in fields)
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                conn.execute(f"UPDATE ingest_jobs SET {sets} WHERE id = ?", (*fields.values(), job_id))
+
+    def _spool(self, job_id: str, path_in_bucket: str, data: bytes) -> str:
+        os.makedirs(self.spool_dir, exist_ok=True)
+        _, ext = os.path.splitext(path_in_bucket)
+        local_path = os.path.join(self.spool_dir, job_id + (ext or ".bin"))
+        with open(local_path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(local_path + ".tmp", local_path)
+        return local_path
+
+    def enqueue(self, username: str, title: str, path_in_bucket: str, data: bytes | None = None) -> str:
+        """
+        Add a job; data (the uploaded bytes) is spooled to disk so the
+        worker doesn't have to download the object again.
+        """
+        job_id = str(uuid.uuid4())
+        local_path = self._spool(job_id, path_in_bucket, data) if data is not None else None
+        now = time.time()
+        try:
+            with self._write_lock:
+                conn = self._conn()
+                with conn:
+                    conn.execute(
+                        "INSERT INTO ingest_jobs (id, username, title, path_in_bucket, local_path, "
+                        "status, stage, created_at, updated_at) "
+                        "VALUES (?, ?, ?, ?, ?, 'queued', 'queued', ?, ?)",
+                        (job_id, username, title, path_in_bucket, local_path, now, now),
+                    )
+        except Exception:
+            if local_path:
+                os.remove(local_path)
+            raise
+        self.wakeup.set()
+        print("➡️ Queued ingest job", job_id, "for", path_in_bucket)
+        return job_id
+
+    def claim(self):
+        """Mark the oldest queued job running and return it, or None."""
+        with self._write_lock:
+            conn = self._conn()
+            while True:
+                row = conn.execute(
+                    f"SELECT {', '.join(_COLUMNS)} FROM ingest_jobs WHERE status = 'queued' "
+                    "ORDER BY created_at LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    return None
+                with conn:
+                    cur = conn.execute(
+                        "UPDATE ingest_jobs SET status = 'running', attempts = attempts + 1, "
+                        "updated_at = ? WHERE id = ? AND status = 'queued'",
+                        (time.time(), row["id"]),
+                    )
+                if cur.rowcount == 1:
+                    return dict(row)
+                # another process claimed it first; try the next one
+
+    def set_stage(self, job_id: str, stage: str):
+        self._update(job_id, stage=stage)
+
+    def finish(self, job_id: str, local_path: str | None = None):
+        self._update(job_id, status="done", stage="indexed", error=None, local_path=None)
+        self._unspool(local_path)
+
+    def fail(self, job_id: str, error: str, local_path: str | None = None):
+        self._update(job_id, status="failed", error=error, local_path=None)
+        self._unspool(local_path)
+
+    @staticmethod
+    def _unspool(local_path):
+        if local_path:
+            try:
+                os.remove(local_path)
+            except FileNotFoundError:
+                pass
+
+    def requeue_running(self) -> int:
+        """Put jobs left 'running' by a crashed worker back in the queue."""
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                cur = conn.execute(
+                    "UPDATE ingest_jobs SET status = 'queued', stage = 'queued', updated_at = ? "
+                    "WHERE status = 'running'",
+                    (time.time(),),
+                )
+        if cur.rowcount:
+            print(f"♻️ Re-queued {cur.rowcount} interrupted ingest jobs")
+        return cur.rowcount
+
+    def prune(self, max_age_s: float = INGEST_JOB_RETENTION_S) -> int:
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                cur = conn.execute(
+                    "DELETE FROM ingest_jobs WHERE status IN ('done', 'failed') AND updated_at < ?",
+                    (time.time() - max_age_s,),
+                )
+        return cur.rowcount
+
+    def jobs(self, username: str, job_ids=None, limit: int = 50):
+        """The user's jobs, newest first; only job_ids when given."""
+        conn = self._conn()
+        if job_ids:
+            job_ids = list(job_ids)[:500]
+            marks = ",".join("?" * len(job_ids))
+            cur = conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM ingest_jobs WHERE username = ? "
+                f"AND id IN ({marks}) ORDER BY created_at DESC",
+                (username, *job_ids),
+            )
+        else:
+            cur = conn.execute(
+                f"SELECT {', '.join(_COLUMNS)} FROM ingest_jobs WHERE username = ? "
+                "ORDER BY created_at DESC LIMIT ?",
+                (username, limit),
+            )
+        return [{k: r[k] for k in _COLUMNS if k != "local_path"} for r in cur]
+
+    def counts(self):
+        cur = self._conn().execute("SELECT status, COUNT(*) FROM ingest_jobs GROUP BY status")
+        return {status: n for status, n in cur}
+
+
+class IngestWorkers:
+    """
+    Background threads draining an IngestQueue. handler(job, set_stage)
+    runs one job; set_stage(name) records progress. A raised exception
+    marks the job failed.
+    """
+
+    def __init__(self, jobs: IngestQueue, handler, num_workers: int):
+        self.jobs = jobs
+        self.handler = handler
+        self.num_workers = num_workers
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self._threads:
+                return
+            self.jobs.requeue_running()
+            self.jobs.prune()
+            for n in range(self.num_workers):
+                t = threading.Thread(target=self._run, name=f"ingest-worker-{n}", daemon=True)
+                t.start()
+                self._threads.append(t)
+        print(f"🚀 Started {self.num_workers} ingest workers")
+
+    def _run(self):
+        while True:
+            job = self.jobs.claim()
+            if job is None:
+                self.jobs.wakeup.wait(timeout=INGEST_POLL_S)
+                self.jobs.wakeup.clear()
+                continue
+
+            job_id = job["id"]
+            started = time.perf_counter()
+            try:
+                self.handler(job, lambda stage: self.jobs.set_stage(job_id, stage))
+            except Exception as e:
+                print("INGEST ERROR for", job["path_in_bucket"], ":", e)
+                self.jobs.fail(job_id, str(e), job["local_path"])
+                continue
+            self.jobs.finish(job_id, job["local_path"])
+            print(f"✅ Ingest job {job_id} done in {time.perf_counter() - started:.1f}s")
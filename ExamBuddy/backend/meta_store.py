@@ -0,0 +1,333 @@
+# backend/meta_store.py
+
+import os
+import re
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+
+# -------------------------
+# Chunk metadata store
+# -------------------------
+# One row per FAISS vector; the SQLite rowid *is* the FAISS id, so a search
+# only fetches the k rows it returns instead of parsing every chunk.
+META_DB_PATH = os.path.join("faiss_store", "meta.sqlite")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    uuid          TEXT NOT NULL,
+    username      TEXT NOT NULL,
+    folder_title  TEXT,
+    doc_path      TEXT,
+    root_type     TEXT,            -- uploaded | generated_notes | ...
+    section_title TEXT,
+    chunk_index   INTEGER,
+    content       TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_chunks_username ON chunks(username);
+CREATE INDEX IF NOT EXISTS idx_chunks_user_doc ON chunks(username, doc_path);
+"""
+
+# retrieval filters (see ids_matching); created after the root_type migration
+_FILTER_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_chunks_user_folder ON chunks(username, folder_title);
+CREATE INDEX IF NOT EXISTS idx_chunks_user_root ON chunks(username, root_type);
+"""
+FILTER_FIELDS = ("folder_title", "doc_path", "root_type")
+
+# BM25 inverted index over section titles + content, rowid = chunks.id.
+# ukey holds one opaque token per user so a query only walks that user's
+# postings. Kept in sync by MetaStore in the same transaction as chunks.
+_FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5(
+    ukey, section_title, content, tokenize = 'unicode61 remove_diacritics 2'
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts_vocab USING fts5vocab(chunks_fts, 'row');
+"""
+FTS_TITLE_WEIGHT = 2.0  # a term in the section title counts double
+# Terms in more than this share of all chunks are dropped from queries:
+# their BM25 weight is ~0 but scoring their postings dominates query time.
+FTS_MAX_DOC_FRACTION = 0.2
+FTS_PRUNE_MIN_DOCS = 1000  # small corpora are fast anyway; keep every term
+
+_COLUMNS = ("id", "uuid", "username", "folder_title", "doc_path", "root_type",
+            "section_title", "chunk_index", "content")
+
+_STOPWORDS = frozenset(
+    "a an and are as at be by can do does explain for from give how i in is it me "
+    "of on or please tell that the this to was what when where which who why with you".split()
+)
+
+
+def root_type_of(doc_path: str | None):
+    """Bucket paths are <root_type>/<user>/<title>/<file>."""
+    if not doc_path or "/" not in doc_path:
+        return None
+    return doc_path.split("/", 1)[0]
+
+
+def _filter_sql(filters):
+    """(" AND ..." clause, params) for a {field: value} retrieval filter."""
+    fields = [f for f in FILTER_FIELDS if (filters or {}).get(f)]
+    return "".join(f" AND {f} = ?" for f in fields), [filters[f] for f in fields]
+
+
+def _user_key(username: str) -> str:
+    return "u" + hashlib.sha1(username.encode("utf-8")).hexdigest()[:16]
+
+
+def query_terms(text: str):
+    """
+    Free text -> [word parts] per whitespace term, stopwords dropped.
+    "TCP/IP" -> ["tcp", "ip"], matched as a phrase.
+    """
+    terms = []
+    for raw in text.split():
+        parts = re.findall(r"\w+", raw.lower())
+        if not parts or (len(parts) == 1 and parts[0] in _STOPWORDS):
+            continue
+        if parts not in terms:
+            terms.append(parts)
+    return terms
+
+
+def fts_query(terms) -> str:
+    """[word parts] -> FTS5 OR-query of quoted phrases."""
+    return " OR ".join('"' + " ".join(parts) + '"' for parts in terms)
+
+
+class MetaStore:
+    """
+    SQLite-backed metadata keyed by FAISS id.
+    O(1) row fetch by id, append-only inserts, lookups by username/doc_path.
+    One connection per thread; WAL journaling lets readers run during writes.
+    """
+
+    def __init__(self, db_path: str = META_DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        conn = self._conn()
+        conn.executescript(_SCHEMA)
+        self._migrate_root_type(conn)
+        conn.executescript(_FILTER_INDEXES)
+        self.fts = self._init_fts(conn)
+        self._doc_total = (0, 0.0)  # (chunk count, when counted)
+        if hasattr(os, "register_at_fork"):
+            # a SQLite connection must not be used across fork (serve.py)
+            os.register_at_fork(after_in_child=self._drop_connections)
+
+    def _drop_connections(self):
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+    def _migrate_root_type(self, conn):
+        """Stores created before root_type: add it, derived from doc_path."""
+        cols = {r["name"] for r in conn.execute("PRAGMA table_info(chunks)")}
+        if "root_type" in cols:
+            return
+        with self._write_lock, conn:
+            conn.execute("ALTER TABLE chunks ADD COLUMN root_type TEXT")
+            cur = conn.execute(
+                "UPDATE chunks SET root_type = substr(doc_path, 1, instr(doc_path, '/') - 1) "
+                "WHERE instr(doc_path, '/') > 1"
+            )
+        if cur.rowcount:
+            print(f"✅ Added root_type to {cur.rowcount} existing chunks")
+
+    def _init_fts(self, conn) -> bool:
+        """Create the BM25 table (backfilling existing chunks once)."""
+        existed = conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'chunks_fts'"
+        ).fetchone() is not None
+        try:
+            conn.executescript(_FTS_SCHEMA)
+        except sqlite3.OperationalError as e:
+            print("⚠️ SQLite FTS5 unavailable, lexical search disabled:", e)
+            return False
+        usernames = [] if existed else self.usernames()
+        if usernames:
+            with self._write_lock, conn:
+                for username in usernames:
+                    conn.execute(
+                        "INSERT INTO chunks_fts (rowid, ukey, section_title, content) "
+                        "SELECT id, ?, section_title, content FROM chunks WHERE username = ?",
+                        (_user_key(username), username),
+                    )
+            print(f"✅ Built BM25 index for the existing chunks of {len(usernames)} users")
+        return True
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def add_rows(self, rows):
+        """
+        Append metadata rows (their "id" is the chunk uuid). Returns the new
+        FAISS ids in the same order as rows.
+        """
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                return self._insert(conn, rows)
+
+    def _insert(self, conn, rows):
+        ids = []
+        for r in rows:
+            cur = conn.execute(
+                "INSERT INTO chunks (uuid, username, folder_title, doc_path, root_type, "
+                "section_title, chunk_index, content) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (r["id"], r["username"], r.get("folder_title"), r.get("doc_path"),
+                 r.get("root_type") or root_type_of(r.get("doc_path")),
+                 r.get("section_title"), r.get("chunk_index"), r.get("content")),
+            )
+            ids.append(cur.lastrowid)
+            if self.fts:
+                conn.execute(
+                    "INSERT INTO chunks_fts (rowid, ukey, section_title, content) VALUES (?, ?, ?, ?)",
+                    (cur.lastrowid, _user_key(r["username"]), r.get("section_title") or "",
+                     r.get("content") or ""),
+                )
+        return ids
+
+    def replace_doc(self, username: str, doc_path: str, rows):
+        """
+        Delete every row of (username, doc_path) and append rows, in one
+        transaction. Returns (old_ids, new_ids).
+        """
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                old_ids = [r[0] for r in conn.execute(
+                    "SELECT id FROM chunks WHERE username = ? AND doc_path = ?", (username, doc_path)
+                )]
+                conn.execute(
+                    "DELETE FROM chunks WHERE username = ? AND doc_path = ?", (username, doc_path)
+                )
+                if self.fts:
+                    conn.executemany("DELETE FROM chunks_fts WHERE rowid = ?", [(i,) for i in old_ids])
+                new_ids = self._insert(conn, rows)
+        return old_ids, new_ids
+
+    def fetch(self, ids):
+        """Returns {faiss_id: row_dict} for the ids that exist."""
+        ids = [int(i) for i in ids]
+        if not ids:
+            return {}
+        marks = ",".join("?" * len(ids))
+        cur = self._conn().execute(
+            f"SELECT {', '.join(_COLUMNS)} FROM chunks WHERE id IN ({marks})", ids
+        )
+        out = {}
+        for row in cur:
+            d = dict(row)
+            d["faiss_id"] = d.pop("id")
+            d["id"] = d.pop("uuid")
+            out[d["faiss_id"]] = d
+        return out
+
+    def lexical_search(self, username: str, query: str, limit: int, filters=None):
+        """
+        BM25 over the user's section titles + content, restricted to rows
+        matching filters ({folder_title, doc_path, root_type}) when given.
+        Returns [(faiss_id, bm25)] best first; bm25 is FTS5's (lower = better).
+        """
+        if not self.fts:
+            return []
+        match = fts_query(self._selective_terms(query_terms(query)))
+        if not match:
+            return []
+        where, params = _filter_sql(filters)
+        if where:
+            where = f" AND rowid IN (SELECT id FROM chunks WHERE username = ?{where})"
+            params = [username, *params]
+        cur = self._conn().execute(
+            "SELECT rowid, bm25(chunks_fts, 0.0, ?, 1.0) AS score FROM chunks_fts "
+            f"WHERE chunks_fts MATCH ?{where} ORDER BY score LIMIT ?",
+            (FTS_TITLE_WEIGHT, f"ukey : {_user_key(username)} AND ({match})", *params, limit),
+        )
+        return [(r[0], r[1]) for r in cur]
+
+    def _selective_terms(self, terms):
+        """Drop terms (phrases: by their rarest word) found in too many chunks."""
+        conn = self._conn()
+        total, counted_at = self._doc_total
+        if time.time() - counted_at > 60:
+            total = conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+            self._doc_total = (total, time.time())
+        if total < FTS_PRUNE_MIN_DOCS:
+            return terms
+
+        limit = total * FTS_MAX_DOC_FRACTION
+        kept = []
+        for parts in terms:
+            docs = []
+            for word in parts:
+                row = conn.execute("SELECT doc FROM chunks_fts_vocab WHERE term = ?", (word,)).fetchone()
+                docs.append(row[0] if row else 0)
+            if min(docs) <= limit:
+                kept.append(parts)
+        return kept
+
+    def ids_for_user(self, username: str):
+        """FAISS ids of every row of the user (partition reconciliation)."""
+        cur = self._conn().execute("SELECT id FROM chunks WHERE username = ?", (username,))
+        return [r[0] for r in cur]
+
+    def ids_matching(self, username: str, filters):
+        """FAISS ids of the user's rows matching {folder_title, doc_path, root_type}."""
+        where, params = _filter_sql(filters)
+        cur = self._conn().execute(f"SELECT id FROM chunks WHERE username = ?{where}", (username, *params))
+        return [r[0] for r in cur]
+
+    def rows_matching(self, username: str, filters, limit: int):
+        """
+        The user's rows matching filters in document order (doc_path, then
+        insertion), at most limit; same dicts as fetch().
+        """
+        where, params = _filter_sql(filters)
+        cur = self._conn().execute(
+            f"SELECT {', '.join(_COLUMNS)} FROM chunks WHERE username = ?{where} "
+            "ORDER BY doc_path, id LIMIT ?",
+            (username, *params, limit),
+        )
+        out = []
+        for row in cur:
+            d = dict(row)
+            d["faiss_id"] = d.pop("id")
+            d["id"] = d.pop("uuid")
+            out.append(d)
+        return out
+
+    def sample_contents(self, limit: int):
+        cur = self._conn().execute("SELECT content FROM chunks ORDER BY id LIMIT ?", (limit,))
+        return [r[0] for r in cur if r[0]]
+
+    def usernames(self):
+        cur = self._conn().execute("SELECT DISTINCT username FROM chunks")
+        return [r[0] for r in cur]
+
+
+def import_json_meta(json_path: str, store: MetaStore):
+    """
+    One-shot converter from a faiss_meta.json style list into the store.
+    Returns the FAISS ids assigned to each JSON row, in file order, so the
+    caller can re-key the matching vectors.
+    """
+    print("➡️ import_json_meta:", json_path)
+    with open(json_path, "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    ids = store.add_rows(meta)
+    print(f"✅ Imported {len(ids)} metadata rows into {store.db_path}")
+    return ids
+
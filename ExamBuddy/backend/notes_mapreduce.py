@@ -0,0 +1,390 @@
+# backend/notes_mapreduce.py
+
+import os
+import re
+import time
+import uuid
+import random
+import hashlib
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from langchain_core.messages import HumanMessage, SystemMessage
+
+from rag_local import chunk_store, search_multi_query, retrieval_filters
+
+# -------------------------
+# Map-reduce notes generation
+# -------------------------
+# For notes over a whole course, one prompt can't hold every chunk.
+#   map     the topic's chunks are grouped by document section (packed up
+#           to NOTES_GROUP_WORDS) and each group is condensed by the LLM,
+#           NOTES_MAP_WORKERS calls at a time
+#   reduce  the condensed groups are merged into the requested note format
+#           (with intermediate merge rounds if they still don't fit)
+# Every map/merge output is cached by (topic, input text), so retrying a
+# failed or timed-out request only calls the LLM for groups not done yet.
+# Progress is kept per run_id for /api/notes-progress.
+#
+# The run is synchronous: /api/generate-notes holds the request open until
+# the notes are done, and the client polls /api/notes-progress meanwhile.
+# At the default limits (NOTES_MAP_MAX_CHUNKS chunks, ~100 map calls,
+# NOTES_MAP_WORKERS at a time) that is 2-3 minutes uncached, longer under
+# rate limiting; proxies or gunicorn in front need a request timeout of at
+# least 300 s (gunicorn's default 30 s kills the worker mid-run).
+NOTES_MAPREDUCE_DB_PATH = os.path.join("faiss_store", "notes_mapreduce.sqlite")
+NOTES_MAP_WORKERS = int(os.getenv("NOTES_MAP_WORKERS", "4"))
+NOTES_MAP_MAX_CHUNKS = int(os.getenv("NOTES_MAP_MAX_CHUNKS", "600"))
+NOTES_TOPIC_CHUNKS = 150         # chunks retrieved for the topic when no folder/doc is given
+# Budgets are in whitespace-separated words (no LLM tokenizer here); English
+# runs ~1.3 tokens per word, so these stay well inside an 8k-token prompt.
+NOTES_GROUP_WORDS = 1800         # input words per map call
+NOTES_REDUCE_WORDS = 3000        # summary words merged in one reduce call
+NOTES_LLM_MAX_RETRIES = 5
+NOTES_BACKOFF_S = 2.0            # first rate-limit backoff; doubles per retry
+NOTES_MAP_CACHE_MAX_AGE_S = 30 * 24 * 3600
+NOTES_RUN_RETENTION_S = 24 * 3600
+NOTES_MAP_PROMPT_VERSION = "1"   # bump when the map/merge prompts change
+
+MAP_PROMPT = (
+    "You condense a student's uploaded notes for exam preparation on the topic '{topic}'.\n"
+    "Keep every definition, formula, list, example and fact relevant to the topic, "
+    "as compact bullet points under short headings. Drop unrelated material.\n"
+    "Use only the given notes. If nothing in them is relevant, reply exactly NONE."
+)
+MERGE_PROMPT = (
+    "You merge partial study notes on the topic '{topic}' into one set of compact "
+    "bullet points under short headings. Remove repetition but keep every distinct "
+    "fact, formula and example. Use only the given notes."
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS map_results (
+    key        TEXT PRIMARY KEY,
+    summary    TEXT NOT NULL,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS notes_runs (
+    run_id     TEXT NOT NULL,   -- client-chosen, so only unique per user
+    username   TEXT NOT NULL,
+    topic      TEXT,
+    stage      TEXT NOT NULL,   -- collecting | map | reduce | done | failed
+    done       INTEGER NOT NULL DEFAULT 0,
+    total      INTEGER NOT NULL DEFAULT 0,
+    cached     INTEGER NOT NULL DEFAULT 0,
+    error      TEXT,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (username, run_id)
+);
+"""
+
+_RUN_COLUMNS = ("run_id", "username", "topic", "stage", "done", "total", "cached", "error", "updated_at")
+
+
+class NotesMapStore:
+    """
+    SQLite cache of map/merge outputs plus per-run progress, shared by
+    every worker process.
+    """
+
+    def __init__(self, db_path: str = NOTES_MAPREDUCE_DB_PATH):
+        self.db_path = db_path
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        conn = self._conn()
+        self._migrate_runs_key(conn)
+        conn.executescript(_SCHEMA)
+        with conn:
+            conn.execute("DELETE FROM map_results WHERE created_at < ?",
+                         (time.time() - NOTES_MAP_CACHE_MAX_AGE_S,))
+            conn.execute("DELETE FROM notes_runs WHERE updated_at < ?",
+                         (time.time() - NOTES_RUN_RETENTION_S,))
+        if hasattr(os, "register_at_fork"):
+            # a SQLite connection must not be used across fork (serve.py)
+            os.register_at_fork(after_in_child=self._drop_connections)
+
+    def _drop_connections(self):
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+    def _migrate_runs_key(self, conn):
+        """Stores keyed on run_id alone: drop that table (rows are short-lived progress)."""
+        pk = [r[1] for r in sorted(conn.execute("PRAGMA table_info(notes_runs)"), key=lambda r: r[5]) if r[5]]
+        if pk == ["run_id"]:
+            with conn:
+                conn.execute("DROP TABLE notes_runs")
+            print("ℹ️ Recreated notes_runs keyed on (username, run_id)")
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            os.makedirs(os.path.dirname(self.db_path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str):
+        row = self._conn().execute("SELECT summary FROM map_results WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, summary: str):
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO map_results (key, summary, created_at) VALUES (?, ?, ?)",
+                    (key, summary, time.time()),
+                )
+
+    def set_progress(self, run_id: str, username: str, topic: str, stage: str,
+                     done: int = 0, total: int = 0, cached: int = 0, error: str | None = None):
+        with self._write_lock:
+            conn = self._conn()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO notes_runs "
+                    f"({', '.join(_RUN_COLUMNS)}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (run_id, username, topic, stage, done, total, cached, error, time.time()),
+                )
+
+    def progress(self, username: str, run_id: str):
+        row = self._conn().execute(
+            f"SELECT {', '.join(_RUN_COLUMNS)} FROM notes_runs WHERE run_id = ? AND username = ?",
+            (run_id, username),
+        ).fetchone()
+        return dict(zip(_RUN_COLUMNS, row)) if row else None
+
+
+map_store = NotesMapStore()
+
+
+# -------------------------
+# Rate-limit aware LLM calls
+# -------------------------
+class _RateGate:
+    """
+    When one worker is rate limited, every worker waits out the same
+    cool-down instead of each hammering the API on its own schedule.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._until = 0.0
+
+    def wait(self):
+        while True:
+            with self._lock:
+                delay = self._until - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def defer(self, seconds: float):
+        with self._lock:
+            self._until = max(self._until, time.monotonic() + seconds)
+
+
+_rate_gate = _RateGate()
+
+
+def _is_rate_limit(e: Exception) -> bool:
+    if getattr(e, "status_code", None) == 429:
+        return True
+    text = str(e).lower()
+    return "rate limit" in text or "rate_limit" in text or "429" in text
+
+
+def _retry_after(e: Exception, attempt: int) -> float:
+    """Server-suggested wait when there is one, else exponential backoff + jitter."""
+    response = getattr(e, "response", None)
+    header = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    try:
+        if header:
+            return float(header)
+    except ValueError:
+        pass
+    m = re.search(r"try again in ([\d.]+)\s*(ms|s)", str(e))
+    if m:
+        return float(m.group(1)) / (1000.0 if m.group(2) == "ms" else 1.0)
+    return NOTES_BACKOFF_S * (2 ** attempt) + random.uniform(0, 1)
+
+
+def _invoke(llm, messages) -> str:
+    for attempt in range(NOTES_LLM_MAX_RETRIES + 1):
+        _rate_gate.wait()
+        try:
+            return llm.invoke(messages).content.strip()
+        except Exception as e:
+            if not _is_rate_limit(e) or attempt == NOTES_LLM_MAX_RETRIES:
+                raise
+            delay = _retry_after(e, attempt)
+            print(f"⚠️ LLM rate limited, backing off {delay:.1f}s (retry {attempt + 1})")
+            _rate_gate.defer(delay)
+
+
+# -------------------------
+# Map / reduce
+# -------------------------
+def _cache_key(topic: str, prompt: str, text: str) -> str:
+    raw = "\x00".join((NOTES_MAP_PROMPT_VERSION, prompt, topic.lower(), text))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def collect_chunks(username: str, topic: str, queries, folder_title=None, doc_path=None, root_type=None):
+    """
+    The chunks to summarize, in document order: everything in the given
+    folder / doc (when it fits NOTES_MAP_MAX_CHUNKS), otherwise the best
+    matches for the topic's queries.
+    """
+    filters = retrieval_filters(folder_title, doc_path, root_type)
+    rows = chunk_store.rows_matching(username, filters, NOTES_MAP_MAX_CHUNKS + 1) if filters else []
+    if not rows or len(rows) > NOTES_MAP_MAX_CHUNKS:
+        limit = NOTES_MAP_MAX_CHUNKS if filters else NOTES_TOPIC_CHUNKS
+        rows = search_multi_query(username, queries, top_k=limit, folder_title=folder_title,
+                                  doc_path=doc_path, root_type=root_type, lexical_query=topic)
+        rows.sort(key=lambda m: (m["doc_path"] or "", m["faiss_id"]))
+    return rows
+
+
+def _words(text: str) -> int:
+    return len(text.split())
+
+
+def group_chunks(chunks, max_words: int = NOTES_GROUP_WORDS):
+    """
+    Consecutive chunks of the same document packed into groups of at most
+    max_words, starting a new group at a section boundary once the current
+    one is half full. Returns a list of group texts.
+    """
+    groups = []
+    lines, size, doc, section = [], 0, None, None
+    for m in chunks:
+        text = m["content"]
+        n = _words(text)
+        new_section = m["section_title"] != section
+        if lines and (m["doc_path"] != doc or size + n > max_words
+                      or (new_section and size >= max_words // 2)):
+            groups.append("\n\n".join(lines))
+            lines, size = [], 0
+        if new_section or not lines:
+            lines.append(f"## {m.get('folder_title')} / {m['section_title']}")
+        lines.append(text)
+        size += n
+        doc, section = m["doc_path"], m["section_title"]
+    if lines:
+        groups.append("\n\n".join(lines))
+    return groups
+
+
+def _run_parallel(llm, topic: str, prompt: str, texts, on_done):
+    """
+    Condense each text with prompt, NOTES_MAP_WORKERS at a time; cached
+    results are reused. on_done(from_cache) fires per finished text.
+    Returns the outputs in order (failed texts raise).
+    """
+    system = prompt.format(topic=topic)
+
+    def work(text):
+        key = _cache_key(topic, prompt, text)
+        cached = map_store.get(key)
+        if cached is not None:
+            on_done(True)
+            return cached
+        out = _invoke(llm, [SystemMessage(content=system), HumanMessage(content=text)])
+        map_store.put(key, out)
+        on_done(False)
+        return out
+
+    with ThreadPoolExecutor(max_workers=NOTES_MAP_WORKERS, thread_name_prefix="notes-map") as pool:
+        return list(pool.map(work, texts))
+
+
+def _truncate_words(text: str, max_words: int) -> str:
+    """text cut after max_words words, keeping its line breaks."""
+    words = list(re.finditer(r"\S+", text))
+    if len(words) <= max_words:
+        return text
+    return text[: words[max_words - 1].end()] + " …"
+
+
+def _relevant(summary: str) -> bool:
+    return bool(summary) and summary.strip().upper() != "NONE"
+
+
+def generate_notes_map_reduce(llm, username: str, topic: str, queries, system_prompt: str,
+                              user_prompt: str, folder_title=None, doc_path=None, root_type=None,
+                              run_id: str | None = None):
+    """
+    Notes for topic over all of its chunks (see module comment).
+    queries: topic search queries (used when no folder/doc scope is given).
+    Returns (notes, run_id); progress is readable via notes_progress.
+    """
+    run_id = run_id or str(uuid.uuid4())
+    started = time.perf_counter()
+    groups = []
+    counts = {"done": 0, "cached": 0}
+    counts_lock = threading.Lock()
+    map_store.set_progress(run_id, username, topic, "collecting")
+    try:
+        chunks = collect_chunks(username, topic, queries, folder_title, doc_path, root_type)
+        groups = group_chunks(chunks)
+        print(f"➡️ notes map-reduce {run_id}: {len(chunks)} chunks -> {len(groups)} groups")
+
+        def on_done(from_cache: bool):
+            with counts_lock:
+                counts["done"] += 1
+                counts["cached"] += from_cache
+                done, cached = counts["done"], counts["cached"]
+            map_store.set_progress(run_id, username, topic, "map", done, len(groups), cached)
+
+        map_store.set_progress(run_id, username, topic, "map", 0, len(groups))
+        summaries = [s for s in _run_parallel(llm, topic, MAP_PROMPT, groups, on_done) if _relevant(s)]
+
+        # merge rounds until the summaries fit one reduce prompt
+        while len(summaries) > 1 and _words("\n\n".join(summaries)) > NOTES_REDUCE_WORDS:
+            batches, batch, size = [], [], 0
+            for s in summaries:
+                n = _words(s)
+                if batch and size + n > NOTES_REDUCE_WORDS:
+                    batches.append("\n\n".join(batch))
+                    batch, size = [], 0
+                batch.append(s)
+                size += n
+            batches.append("\n\n".join(batch))
+            if len(batches) == len(summaries):
+                # no two summaries fit one prompt: merge pairwise, each cut to
+                # half the budget, so every round still halves the count
+                batches = [
+                    "\n\n".join(_truncate_words(s, NOTES_REDUCE_WORDS // 2) for s in summaries[i:i + 2])
+                    for i in range(0, len(summaries), 2)
+                ]
+            map_store.set_progress(run_id, username, topic, "reduce", 0, len(batches))
+            summaries = _run_parallel(llm, topic, MERGE_PROMPT, batches, lambda _: None)
+
+        # a single oversized summary (or merge outputs still over budget)
+        # gets cut to its share rather than overflowing the final prompt
+        share = NOTES_REDUCE_WORDS // max(len(summaries), 1)
+        summaries = [_truncate_words(s, share) for s in summaries]
+        map_store.set_progress(run_id, username, topic, "reduce", 0, 1)
+        notes = _invoke(llm, [
+            SystemMessage(content=system_prompt),
+            SystemMessage(content="Context (condensed from the user's uploaded notes):\n"
+                                  + "\n\n".join(summaries)),
+            HumanMessage(content=user_prompt),
+        ])
+    except Exception as e:
+        map_store.set_progress(run_id, username, topic, "failed", counts["done"], len(groups),
+                               counts["cached"], error=str(e))
+        raise
+
+    map_store.set_progress(run_id, username, topic, "done", len(groups), len(groups), counts["cached"])
+    print(f"✅ notes map-reduce {run_id}: {len(groups)} groups ({counts['cached']} cached) "
+          f"in {time.perf_counter() - started:.1f}s")
+    return notes, run_id
+
+
+def notes_progress(username: str, run_id: str):
+    return map_store.progress(username, run_id)
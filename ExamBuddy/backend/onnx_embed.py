@@ -0,0 +1,130 @@
+# backend/onnx_embed.py
+
+import os
+import inspect
+
+import numpy as np
+
+# -------------------------
+# ONNX Runtime embedding backend
+# -------------------------
+# Same math as the sentence-transformers all-MiniLM-L6-v2 pipeline
+# (transformer -> mean pooling over the attention mask -> L2 normalize),
+# but run through onnxruntime, optionally with int8 dynamic quantization.
+ONNX_FILE = "model.onnx"
+ONNX_INT8_FILE = "model.int8.onnx"
+MAX_SEQ_LENGTH = 256  # sentence-transformers' max_seq_length for all-MiniLM-L6-v2
+
+
+def export_onnx(model_name: str, out_dir: str) -> str:
+    """
+    Export the Hugging Face transformer behind model_name to out_dir/model.onnx
+    and save its tokenizer next to it. Needs torch + transformers.
+    """
+    import torch
+    from transformers import AutoModel, AutoTokenizer
+
+    print("➡️ Exporting", model_name, "to ONNX in", out_dir)
+    os.makedirs(out_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    model = AutoModel.from_pretrained(model_name)
+    model.eval()
+
+    sample = tokenizer(["warm up"], return_tensors="pt")
+    input_names = [n for n in ("input_ids", "attention_mask", "token_type_ids") if n in sample]
+
+    class _Encoder(torch.nn.Module):
+        # pass inputs by name; positional order differs across transformers versions
+        def __init__(self, inner):
+            super().__init__()
+            self.inner = inner
+
+        def forward(self, *inputs):
+            return self.inner(**dict(zip(input_names, inputs))).last_hidden_state
+    dynamic_axes = {n: {0: "batch", 1: "seq"} for n in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "seq"}
+
+    extra = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        # newer torch defaults to the dynamo exporter; keep the TorchScript
+        # one that dynamic_axes is written for
+        extra["dynamo"] = False
+
+    out_path = os.path.join(out_dir, ONNX_FILE)
+    with torch.no_grad():
+        torch.onnx.export(
+            _Encoder(model),
+            tuple(sample[n] for n in input_names),
+            out_path,
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes,
+            opset_version=14,
+            **extra,
+        )
+    tokenizer.save_pretrained(out_dir)
+    print("✅ ONNX export written:", out_path)
+    return out_path
+
+
+def quantize_onnx(src_path: str, dst_path: str) -> str:
+    """int8 dynamic (weight-only) quantization of an exported model."""
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+
+    print("➡️ Quantizing", src_path, "-> int8")
+    quantize_dynamic(src_path, dst_path, weight_type=QuantType.QInt8)
+    print("✅ Quantized model written:", dst_path)
+    return dst_path
+
+
+class OnnxEmbedder:
+    """
+    Drop-in for SentenceTransformer.encode() backed by onnxruntime.
+    intra_op_threads=0 lets onnxruntime pick (all physical cores).
+    """
+
+    def __init__(self, model_dir: str, quantized: bool = False, intra_op_threads: int = 0):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_path = os.path.join(model_dir, ONNX_INT8_FILE if quantized else ONNX_FILE)
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = intra_op_threads
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, opts, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_seq_length = MAX_SEQ_LENGTH
+
+    def encode(self, texts, batch_size: int = 32, show_progress_bar: bool = False,
+               convert_to_numpy: bool = True, normalize_embeddings: bool = True):
+        if isinstance(texts, str):
+            texts = [texts]
+        out = []
+        for start in range(0, len(texts), batch_size):
+            batch = texts[start:start + batch_size]
+            enc = self.tokenizer(
+                batch, padding=True, truncation=True,
+                max_length=self.max_seq_length, return_tensors="np",
+            )
+            feeds = {k: v.astype("int64") for k, v in enc.items() if k in self.input_names}
+            hidden = self.session.run(["last_hidden_state"], feeds)[0]
+
+            mask = enc["attention_mask"][..., None].astype("float32")
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            out.append(pooled.astype("float32"))
+        return np.concatenate(out) if out else np.empty((0, 0), dtype="float32")
+
+
+def load_onnx_embedder(model_name: str, model_dir: str, quantized: bool = False,
+                       intra_op_threads: int = 0) -> OnnxEmbedder:
+    """Export (and quantize) on first use, then open an inference session."""
+    fp32_path = os.path.join(model_dir, ONNX_FILE)
+    if not os.path.exists(fp32_path):
+        export_onnx(model_name, model_dir)
+    int8_path = os.path.join(model_dir, ONNX_INT8_FILE)
+    if quantized and not os.path.exists(int8_path):
+        quantize_onnx(fp32_path, int8_path)
+    return OnnxEmbedder(model_dir, quantized=quantized, intra_op_threads=intra_op_threads)
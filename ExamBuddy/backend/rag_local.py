@@ -1,15 +1,31 @@
 # backend/rag_local.py
 
 import os
+import re
 import json
+import math
+import hashlib
+import struct
+import zlib
+import time
+import queue
 import uuid
 import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 
-from sentence_transformers import SentenceTransformer
+import numpy as np
 import faiss
-from unstructured.partition.auto import partition
 
 from config import supabase, STORAGE_BUCKET  # shared config (Supabase, etc.)
+from meta_store import MetaStore, import_json_meta, root_type_of
+from embed_cache import EmbeddingCache
+from ingest_queue import IngestQueue, IngestWorkers
+from doc_partition import partition_document, partition_stats
+from chunker import chunk_sections
+from context_pack import pack_context, context_stats, CONTEXT_TOKEN_BUDGET
+from onnx_embed import load_onnx_embedder
 
 # -------------------------
 # Local embedding model
@@ -17,12 +33,89 @@ from config import supabase, STORAGE_BUCKET  # shared config (Supabase, etc.)
 MODEL_NAME = "sentence-transformers/all-MiniLM-L6-v2"
 EMBED_DIM = 384  # all-MiniLM-L6-v2 output dim
 
-print(f"🧠 Loading local embedding model: {MODEL_NAME}")
-embed_model = SentenceTransformer(MODEL_NAME)
+# torch: sentence-transformers on PyTorch
+# onnx / onnx-int8: exported once to ONNX_MODEL_DIR, run on onnxruntime
+# (check with bench_embed_backends.py before switching)
+EMBED_BACKEND = os.getenv("EMBED_BACKEND", "torch")
+ONNX_MODEL_DIR = os.path.join("onnx_models", "all-MiniLM-L6-v2")
+EMBED_ONNX_THREADS = int(os.getenv("EMBED_ONNX_THREADS", "0"))  # 0 = onnxruntime default
+
+
+def load_embed_model(backend: str = EMBED_BACKEND):
+    if backend == "torch":
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(MODEL_NAME)
+    if backend in ("onnx", "onnx-int8"):
+        return load_onnx_embedder(
+            MODEL_NAME, ONNX_MODEL_DIR,
+            quantized=backend == "onnx-int8",
+            intra_op_threads=EMBED_ONNX_THREADS,
+        )
+    raise ValueError(f"Unknown EMBED_BACKEND: {backend}")
+
+
+# vectors differ slightly between backends, so they don't share cache rows
+EMBED_CACHE_MODEL = f"{MODEL_NAME}@{EMBED_BACKEND}"
+
+# The model is loaded on first use (or by warm_up), so importing this module
+# stays cheap for app.py workers and CLI scripts.
+embed_model = None
+_embed_model_lock = threading.Lock()  # held only while the model loads
+_ready = threading.Event()
+_warm_up_started = threading.Event()
+_warm_up_start_lock = threading.Lock()
+
+
+def get_embed_model():
+    global embed_model
+    if embed_model is None:
+        with _embed_model_lock:
+            if embed_model is None:
+                print(f"🧠 Loading local embedding model: {MODEL_NAME} ({EMBED_BACKEND})")
+                embed_model = load_embed_model()
+    return embed_model
+
+
+def warm_up():
+    """Load the embedding model and run one encode so first requests are fast."""
+    started = time.perf_counter()
+    get_embed_model().encode(["warm up"], show_progress_bar=False, convert_to_numpy=True)
+    if RERANK_ENABLED:
+        get_rerank_model().predict([("warm up", "warm up")], show_progress_bar=False)
+    _ready.set()
+    print(f"✅ RAG warm-up done in {time.perf_counter() - started:.1f}s")
+
+
+def start_warm_up():
+    """
+    warm_up() on a background thread; is_ready() flips when it finishes.
+    Only the first call in a process starts it; later calls return at once,
+    even while the model is still loading (it runs on every request).
+    """
+    if _warm_up_started.is_set():
+        return
+    with _warm_up_start_lock:
+        if _warm_up_started.is_set():
+            return
+        _warm_up_started.set()
+
+    def run():
+        try:
+            warm_up()
+        except Exception as e:
+            print("RAG WARM-UP ERROR:", e)
+
+    threading.Thread(target=run, name="rag-warm-up", daemon=True).start()
+
+
+def is_ready() -> bool:
+    return _ready.is_set()
 
 # -------------------------
 # FAISS index paths
 # -------------------------
+FAISS_STORE_DIR = "faiss_store"  # one snapshot+WAL dir per user + meta.sqlite
+# legacy single global index, migrated into FAISS_STORE_DIR on first use
 FAISS_INDEX_PATH = "faiss_index.bin"
 FAISS_META_PATH = "faiss_meta.json"
 
@@ -30,23 +123,62 @@ FAISS_META_PATH = "faiss_meta.json"
 # -------------------------
 # 1) Download from Supabase
 # -------------------------
-def download_file_from_supabase(path_in_bucket: str) -> str:
-    print("➡️ download_file_from_supabase:", path_in_bucket)
+DOWNLOAD_BLOCK_BYTES = 1024 * 1024
+DOWNLOAD_URL_TTL_S = 300
+
+
+def _stream_download(path_in_bucket: str, out) -> int:
+    """
+    Copy the object into the open file out, block by block, through a
+    short-lived signed URL. Falls back to the client's whole-object
+    download if no URL can be made. Returns the byte count.
+    """
+    bucket = supabase.storage.from_(STORAGE_BUCKET)
+    url = None
+    try:
+        signed = bucket.create_signed_url(path_in_bucket, DOWNLOAD_URL_TTL_S)
+        url = signed.get("signedURL") or signed.get("signedUrl")
+    except Exception as e:
+        print("⚠️ create_signed_url failed, using plain download:", e)
 
-    file_bytes = supabase.storage.from_(STORAGE_BUCKET).download(path_in_bucket)
+    if url and url.startswith("http"):
+        import requests
+
+        size = 0
+        with requests.get(url, stream=True, timeout=60) as resp:
+            resp.raise_for_status()
+            for block in resp.iter_content(DOWNLOAD_BLOCK_BYTES):
+                out.write(block)
+                size += len(block)
+        return size
+
+    file_bytes = bucket.download(path_in_bucket)
     if not file_bytes:
         raise RuntimeError(f"Failed to download {path_in_bucket} from Supabase")
+    out.write(file_bytes)
+    return len(file_bytes)
 
-    _, ext = os.path.splitext(path_in_bucket)
-    suffix = ext or ".bin"
 
-    tmp = tempfile.NamedTemporaryFile(delete=False, suffix=suffix)
-    tmp.write(file_bytes)
-    tmp.flush()
-    tmp.close()
+@contextmanager
+def download_file_from_supabase(path_in_bucket: str):
+    """
+    with download_file_from_supabase(path) as local_path: ...
+    Streams the object into a temp file that is deleted on exit.
+    """
+    print("➡️ download_file_from_supabase:", path_in_bucket)
 
-    print("✅ Downloaded to temp file:", tmp.name)
-    return tmp.name
+    _, ext = os.path.splitext(path_in_bucket)
+    fd, local_path = tempfile.mkstemp(suffix=ext or ".bin")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            size = _stream_download(path_in_bucket, f)
+        print(f"✅ Downloaded {size} bytes to temp file:", local_path)
+        yield local_path
+    finally:
+        try:
+            os.remove(local_path)
+        except FileNotFoundError:
+            pass
 
 
 # -------------------------
@@ -54,50 +186,167 @@ def download_file_from_supabase(path_in_bucket: str) -> str:
 # -------------------------
 def partition_and_chunk(local_path: str, title: str):
     """
-    Use Unstructured to partition the doc and create simple title-based chunks.
-    Returns list of chunks: [{"title": ..., "content": ...}, ...]
+    Use Unstructured to partition the doc into title-based sections, then
+    cut each section to the embedding token budget (see chunker.py).
+    Partitioning runs in the process pool (see doc_partition.py).
+    Returns list of chunks: [{"title": ..., "content": ..., "token_count": ...}, ...]
     """
     print("➡️ partition_and_chunk:", local_path)
 
-    elements = partition(filename=local_path)
+    elements = partition_document(local_path)
     print(f"✅ partition: got {len(elements)} elements")
 
-    chunks = []
+    sections = []
     current_title = title
     current_text = []
 
-    for el in elements:
-        txt = getattr(el, "text", "") or ""
-        txt = str(txt).strip()
+    for cat, txt in elements:
+        txt = txt.strip()
         if not txt:
             continue
 
-        cat = getattr(el, "category", None)
-
         if cat == "Title":
             if current_text:
-                chunks.append({
-                    "title": current_title,
-                    "content": "\n".join(current_text),
-                })
+                sections.append((current_title, "\n".join(current_text)))
                 current_text = []
             current_title = txt
         else:
             current_text.append(txt)
 
     if current_text:
-        chunks.append({
-            "title": current_title,
-            "content": "\n".join(current_text),
-        })
+        sections.append((current_title, "\n".join(current_text)))
 
-    print(f"✅ chunking: built {len(chunks)} chunks")
+    tokenizer = getattr(get_embed_model(), "tokenizer", None)
+    chunks = chunk_sections(sections, tokenizer)
+    print(f"✅ chunking: {len(sections)} sections -> {len(chunks)} chunks")
     return chunks
 
 
 # -------------------------
 # 3) Local embeddings
 # -------------------------
+# Concurrent embed_local calls are queued and coalesced into one encode
+# call per window, since batch-of-one is the model's least efficient size.
+EMBED_BATCH_WINDOW_MS = float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))  # 0 disables batching
+EMBED_BATCH_MAX_ITEMS = int(os.getenv("EMBED_BATCH_MAX_ITEMS", "64"))
+
+
+def _encode_texts(texts):
+    return get_embed_model().encode(texts, show_progress_bar=False, convert_to_numpy=True)
+
+
+class _EmbedRequest:
+    __slots__ = ("texts", "done", "result", "error", "enqueued_at")
+
+    def __init__(self, texts):
+        self.texts = texts
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.enqueued_at = time.perf_counter()
+
+
+class EmbeddingBatcher:
+    """
+    Micro-batching scheduler in front of the embedding model.
+    A request waits at most window_ms for others to join (or until
+    max_items texts are queued); one worker thread encodes the merged batch
+    and hands each caller back its own rows. Calls already >= max_items
+    bypass the queue.
+    """
+
+    def __init__(self, encode_fn, window_ms: float, max_items: int):
+        self.encode_fn = encode_fn
+        self.window_s = window_ms / 1000.0
+        self.max_items = max_items
+        self._queue = queue.Queue()
+        self._worker = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._batches = 0
+        self._requests = 0
+        self._items = 0
+        self._max_batch = 0
+        self._wait_s = 0.0
+        self._encode_s = 0.0
+
+    def encode(self, texts):
+        if self.window_s <= 0 or len(texts) >= self.max_items:
+            return self.encode_fn(texts)
+
+        with self._start_lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="embed-batcher", daemon=True)
+                self._worker.start()
+
+        req = _EmbedRequest(texts)
+        self._queue.put(req)
+        req.done.wait()
+        if req.error is not None:
+            raise req.error
+        return req.result
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        n = len(batch[0].texts)
+        deadline = time.perf_counter() + self.window_s
+        while n < self.max_items:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                req = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(req)
+            n += len(req.texts)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            texts = [t for req in batch for t in req.texts]
+            started = time.perf_counter()
+            try:
+                embeddings = self.encode_fn(texts)
+                pos = 0
+                for req in batch:
+                    req.result = embeddings[pos:pos + len(req.texts)]
+                    pos += len(req.texts)
+            except Exception as e:
+                for req in batch:
+                    req.error = e
+            finished = time.perf_counter()
+
+            with self._stats_lock:
+                self._batches += 1
+                self._requests += len(batch)
+                self._items += len(texts)
+                self._max_batch = max(self._max_batch, len(texts))
+                self._wait_s += sum(started - req.enqueued_at for req in batch)
+                self._encode_s += finished - started
+            for req in batch:
+                req.done.set()
+
+    def stats(self):
+        with self._stats_lock:
+            return {
+                "window_ms": self.window_s * 1000,
+                "max_items": self.max_items,
+                "batches": self._batches,
+                "requests": self._requests,
+                "items": self._items,
+                "max_batch": self._max_batch,
+                "avg_batch": round(self._items / self._batches, 2) if self._batches else 0.0,
+                "avg_wait_ms": round(self._wait_s * 1000 / self._requests, 3) if self._requests else 0.0,
+                "avg_encode_ms": round(self._encode_s * 1000 / self._batches, 3) if self._batches else 0.0,
+                "items_per_s": round(self._items / self._encode_s, 1) if self._encode_s else 0.0,
+            }
+
+
+embed_batcher = EmbeddingBatcher(_encode_texts, EMBED_BATCH_WINDOW_MS, EMBED_BATCH_MAX_ITEMS)
+
+
 def embed_local(texts):
     """
     Use local sentence-transformers model to embed texts.
@@ -107,40 +356,997 @@ def embed_local(texts):
     if not texts:
         return []
 
-    embeddings = embed_model.encode(texts, show_progress_bar=False, convert_to_numpy=True)
+    embeddings = embed_batcher.encode(texts)
     print("✅ local embeddings:", embeddings.shape[0], "vectors; dim =", embeddings.shape[1])
     return embeddings  # numpy array (n, d)
 
 
+embed_cache = EmbeddingCache()
+
+
+def embed_chunks(texts):
+    """
+    embed_local with the persistent content-hash cache in front, for
+    ingestion: only chunks whose text was never embedded hit the model.
+    Returns numpy array of shape (n, EMBED_DIM).
+    """
+    if not texts:
+        return []
+
+    cached = embed_cache.get_many(EMBED_CACHE_MODEL, texts)
+    missing = [i for i in range(len(texts)) if i not in cached]
+    print(f"➡️ embed_chunks: {len(cached)} cached, {len(missing)} to embed")
+
+    embeddings = np.empty((len(texts), EMBED_DIM), dtype="float32")
+    for i, vec in cached.items():
+        embeddings[i] = vec
+    if missing:
+        fresh = embed_local([texts[i] for i in missing])
+        embeddings[missing] = fresh
+        embed_cache.put_many(EMBED_CACHE_MODEL, [texts[i] for i in missing], fresh)
+    return embeddings
+
+
+class QueryEmbeddingCache:
+    """
+    Bounded in-process LRU + TTL cache of normalized query text -> embedding
+    for the chat / notes paths, with hit/miss counters for monitoring.
+    """
+
+    def __init__(self, max_size: int, ttl_s: float):
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self._lock = threading.Lock()
+        self._items = OrderedDict()  # key -> (expires_at, vector)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None or item[0] < time.monotonic():
+                if item is not None:
+                    del self._items[key]
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key: str, vector):
+        vector.setflags(write=False)  # shared between requests
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl_s, vector)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "size": len(self._items),
+                "max_size": self.max_size,
+            }
+
+
+QUERY_CACHE_SIZE = 2048
+QUERY_CACHE_TTL_S = 6 * 3600
+query_cache = QueryEmbeddingCache(QUERY_CACHE_SIZE, QUERY_CACHE_TTL_S)
+
+
+def _normalize_query(text: str) -> str:
+    # the MiniLM tokenizer is uncased, so case/whitespace don't change the vector
+    return " ".join(text.lower().split())
+
+
+def embed_query(text: str):
+    """
+    Embedding of one search query, served from query_cache when the same
+    (normalized) question was asked recently. Returns read-only array (d,).
+    """
+    key = _normalize_query(text)
+    vec = query_cache.get(key)
+    if vec is None:
+        vec = embed_local([key])[0]
+        query_cache.put(key, vec)
+    return vec
+
+
+def embed_queries(texts):
+    """
+    embed_query for several queries: cache misses are encoded together in
+    one batch. Returns numpy array (n, d).
+    """
+    keys = [_normalize_query(t) for t in texts]
+    vecs = [query_cache.get(k) for k in keys]
+    missing = sorted({k for k, v in zip(keys, vecs) if v is None})
+    if missing:
+        fresh = dict(zip(missing, embed_local(missing)))
+        for k, v in fresh.items():
+            query_cache.put(k, v)
+        vecs = [fresh[k] if v is None else v for k, v in zip(keys, vecs)]
+    return np.stack(vecs) if vecs else np.empty((0, EMBED_DIM), dtype="float32")
+
+
+def rag_stats():
+    """Counters for monitoring (served by /api/rag-stats)."""
+    return {
+        "ready": is_ready(),
+        "ingest_jobs": ingest_jobs.counts(),
+        "partition": partition_stats(),
+        "rerank": rerank_stats(),
+        "context": context_stats(),
+        "query_cache": query_cache.stats(),
+        "embed_batcher": embed_batcher.stats(),
+    }
+
+
 # -------------------------
 # 4) FAISS index helpers
 # -------------------------
-def _load_faiss_index():
-    if not os.path.exists(FAISS_INDEX_PATH) or not os.path.exists(FAISS_META_PATH):
-        print("ℹ️ No existing FAISS index/meta, starting fresh.")
-        index = faiss.IndexFlatIP(EMBED_DIM)  # cosine via inner product + normalized vectors
-        meta = []
-        return index, meta
+# One partition (sub-index) per username, so a search only scans the
+# requesting user's vectors and top_k always comes from that user.
+# Vectors are keyed by their MetaStore row id (IndexIDMap2), so metadata
+# is fetched per hit instead of loading every chunk.
+#
+# On disk each partition is a directory:
+#   snap-<seq>.index  atomic snapshot covering every WAL segment <= seq
+#   wal-<seq>.log     append-only log of vectors added since the snapshot
+# Ingests only append to the WAL; a background compactor folds segments
+# into a new snapshot (tmp file + os.replace) and deletes the old files.
+# The index has a single writer process; other processes only read and
+# pick up changes through the directory stamp.
+#
+# Under serve.py the pre-forked HTTP workers are read-only: they
+# memory-map the snapshot (pages shared through the OS page cache), replay
+# pending WAL segments into a small private delta index, and reload only
+# when the writer bumps a shared generation counter after each write.
+chunk_store = MetaStore()
+
+FAISS_COMPACT_WAL_BYTES = 8 * 1024 * 1024  # fold the WAL once it gets this big
+FAISS_COMPACT_INTERVAL_S = 60              # ...or on this timer if it's non-empty
+
+# Partitions start as exact Flat indexes; compaction retrains them into
+# FAISS_INDEX_TYPE once they hold FAISS_PROMOTE_AT vectors. For the
+# compressed types (fp16 / sq8 / pq) a low threshold such as 1000 makes
+# sense, since they only trade a little recall for memory.
+FAISS_INDEX_TYPE = os.getenv("FAISS_INDEX_TYPE", "hnsw")
+FAISS_PROMOTE_AT = int(os.getenv("FAISS_PROMOTE_AT", "20000"))
+FAISS_NPROBE = 16      # IVF lists scanned per query
+FAISS_EF_SEARCH = 64   # HNSW candidate list size per query
+# Filters matching at most this many chunks are scored exactly (reconstruct
+# + inner product) instead of through the ANN graph / lists, which come
+# back short when few of the visited candidates pass the selector. Wider
+# filters scale efSearch / nprobe with how narrow they are, up to the cap.
+FAISS_FILTER_EXACT_MAX = 4096
+FAISS_FILTER_MAX_EF = 1024
+HNSW_M = 32
+PQ_M = 48              # 384 dims / 48 sub-quantizers = 8 dims each
+
+_SNAP_RE = re.compile(r"^snap-(\d+)\.index$")
+_WAL_RE = re.compile(r"^wal-(\d+)\.log$")
+
+# WAL record: header (magic, op, n, crc32 of payload) + int64 ids [+ float32 vectors]
+_WAL_HEADER = struct.Struct("<4sIII")
+_WAL_MAGIC = b"FWAL"
+_WAL_ADD = 1
+_WAL_REMOVE = 2
+
+
+def _partition_key(username: str) -> str:
+    safe = re.sub(r"[^A-Za-z0-9_.-]", "_", username)[:64]
+    digest = hashlib.sha1(username.encode("utf-8")).hexdigest()[:8]
+    return f"{safe}-{digest}"
+
+
+def _partition_dir(username: str) -> str:
+    return os.path.join(FAISS_STORE_DIR, _partition_key(username))
+
+
+def _ivf_nlist(n: int) -> int:
+    # ~4*sqrt(n) lists, but keep >= 39 training points per centroid
+    return max(1, min(4 * int(math.sqrt(n)), n // 39))
+
+
+# index type -> factory string for a partition of n vectors.
+# IVF handles ids itself; the others are wrapped in IDMap2.
+# Bytes per 384-dim vector: float32 1536, fp16 768, sq8 384, pq 48.
+# Run bench_faiss_recall.py to compare recall on the real corpus.
+FAISS_INDEX_FACTORIES = {
+    "flat": lambda n: "IDMap2,Flat",
+    "fp16": lambda n: "IDMap2,SQfp16",
+    "sq8": lambda n: "IDMap2,SQ8",
+    "pq": lambda n: f"IDMap2,PQ{PQ_M}",
+    "hnsw": lambda n: f"IDMap2,HNSW{HNSW_M}",
+    "hnsw_sq8": lambda n: f"IDMap2,HNSW{HNSW_M}_SQ8",
+    "ivf_flat": lambda n: f"IVF{_ivf_nlist(n)},Flat",
+    "ivf_sq8": lambda n: f"IVF{_ivf_nlist(n)},SQ8",
+    "ivf_pq": lambda n: f"IVF{_ivf_nlist(n)},PQ{PQ_M}",
+}
+
+
+def make_faiss_index(kind: str, n: int = 0):
+    """Empty (untrained) index of the given type, sized for n vectors."""
+    if kind not in FAISS_INDEX_FACTORIES:
+        raise ValueError(f"Unknown FAISS index type: {kind}")
+    # cosine via inner product + normalized vectors
+    index = faiss.index_factory(EMBED_DIM, FAISS_INDEX_FACTORIES[kind](n), faiss.METRIC_INNER_PRODUCT)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        # id -> (list, offset) map so vectors can be reconstructed/removed by id
+        ivf.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return index
+
+
+def _new_partition_index():
+    return make_faiss_index("flat")
+
+
+def _base_index(index):
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def faiss_index_kind(index) -> str:
+    base = _base_index(index)
+    if isinstance(base, faiss.IndexHNSWSQ):
+        return "hnsw_sq8"
+    if isinstance(base, faiss.IndexHNSW):
+        return "hnsw"
+    if isinstance(base, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(base, faiss.IndexIVFScalarQuantizer):
+        return "ivf_sq8"
+    if isinstance(base, faiss.IndexIVF):
+        return "ivf_flat"
+    if isinstance(base, faiss.IndexPQ):
+        return "pq"
+    if isinstance(base, faiss.IndexScalarQuantizer):
+        return "fp16" if base.sq.qtype == faiss.ScalarQuantizer.QT_fp16 else "sq8"
+    return "flat"
+
+
+def _index_ids(index):
+    """Ids currently stored in a partition index."""
+    if isinstance(index, faiss.IndexIDMap):
+        return faiss.vector_to_array(index.id_map).astype("int64")
+    invlists = faiss.extract_index_ivf(index).invlists
+    return np.concatenate([
+        faiss.rev_swig_ptr(invlists.get_ids(l), invlists.list_size(l)).copy()
+        for l in range(invlists.nlist)
+    ] or [np.empty(0, dtype="int64")]).astype("int64")
+
+
+def _extract_vectors(index):
+    """(ids, vectors) currently stored in a partition index."""
+    ids = _index_ids(index)
+    if isinstance(index, faiss.IndexIDMap):
+        return ids, _base_index(index).reconstruct_n(0, index.ntotal)
+    vectors = index.reconstruct_batch(ids) if len(ids) else np.empty((0, EMBED_DIM), dtype="float32")
+    return ids, vectors
+
+
+def build_faiss_index(kind: str, ids, vectors):
+    """Train (if needed) a new index of the given type and fill it."""
+    index = make_faiss_index(kind, len(ids))
+    if not index.is_trained:
+        print(f"➡️ Training {kind} index on {len(ids)} vectors")
+        index.train(vectors)
+    index.add_with_ids(vectors, ids)
+    return index
+
+
+def faiss_search_params(index, nprobe=None, ef_search=None, sel=None):
+    """
+    Per-query search parameters; sel is an optional faiss.IDSelector on
+    partition ids. The caller must keep sel alive until the search returns.
+    """
+    kind = faiss_index_kind(index)
+    if kind.startswith("hnsw"):
+        return faiss.SearchParametersHNSW(efSearch=ef_search or FAISS_EF_SEARCH, sel=sel)
+    if kind.startswith("ivf"):
+        return faiss.SearchParametersIVF(nprobe=nprobe or FAISS_NPROBE, sel=sel)
+    if sel is not None:
+        return faiss.SearchParameters(sel=sel)
+    return None
+
+
+def _search_index(index, q, k: int, nprobe=None, ef_search=None, allowed=None, tombstones=None):
+    """
+    One index.search over the rows of q, skipping tombstoned ids and (when
+    given) ids outside allowed. Returns one [(faiss_id, score)] list per row.
+    """
+    if tombstones and faiss_index_kind(index) == "pq":
+        # IndexPQ takes no selector: over-fetch and drop the tombstones
+        distances, labels = index.search(q, min(k + len(tombstones), index.ntotal))
+        return [
+            [(int(i), float(d)) for i, d in zip(row_ids, row_d) if i >= 0 and i not in tombstones][:k]
+            for row_ids, row_d in zip(labels.tolist(), distances.tolist())
+        ]
+    sel = removed = keep = None
+    if tombstones:
+        removed = faiss.IDSelectorBatch(np.fromiter(tombstones, dtype="int64"))
+        sel = faiss.IDSelectorNot(removed)
+    if allowed is not None:
+        keep = faiss.IDSelectorBatch(np.asarray(allowed, dtype="int64"))
+        sel = keep if sel is None else faiss.IDSelectorAnd(keep, sel)
+    params = faiss_search_params(index, nprobe, ef_search, sel=sel)
+    distances, labels = index.search(q, k, params=params)
+    return [
+        [(int(i), float(d)) for i, d in zip(row_ids, row_d) if i >= 0]
+        for row_ids, row_d in zip(labels.tolist(), distances.tolist())
+    ]
+
+
+def _remove_from_index(index, ids, tombstones: set):
+    """
+    Delete ids from a partition index. HNSW can't delete in place, so its ids
+    are tombstoned (masked at search time) until compaction rebuilds it.
+    """
+    kind = faiss_index_kind(index)
+    if kind.startswith("hnsw"):
+        tombstones.update(int(i) for i in ids)
+    elif kind.startswith("ivf"):
+        # the hashtable direct map only supports array selectors
+        index.remove_ids(faiss.IDSelectorArray(ids))
+    else:
+        index.remove_ids(faiss.IDSelectorBatch(ids))
+
+
+def _is_mapped(path: str):
+    """True/False whether path is memory-mapped here; None where /proc isn't available."""
+    try:
+        with open("/proc/self/maps", "r") as f:
+            maps = f.read()
+    except OSError:
+        return None
+    return os.path.realpath(path) in maps
+
+
+def _load_faiss_index(index_path: str, mmap: bool = False):
+    """
+    Read a snapshot; with mmap the vector storage stays in the file (shared
+    through the page cache) instead of a private heap copy. IVF inverted
+    lists map with IO_FLAG_MMAP; flat codes (IDMap2 Flat / SQ / PQ and
+    HNSW's storage) need IO_FLAG_MMAP_IFC.
+    """
+    print("➡️ Loading existing FAISS index:", index_path, "(mmap)" if mmap else "")
+    if mmap:
+        with open(index_path, "rb") as f:
+            is_ivf = f.read(2) == b"Iw"  # IVF fourccs: IwFl, IwSq, IwPQ
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if is_ivf else faiss.IO_FLAG_MMAP_IFC
+        index = faiss.read_index(index_path, flags)
+        if _is_mapped(index_path) is False:
+            print("⚠️ FAISS snapshot was read into memory, not mapped:", index_path)
+    else:
+        index = faiss.read_index(index_path)
+    print(f"✅ Loaded FAISS index with {index.ntotal} vectors")
+    return index
+
+
+def _encode_wal_record(op: int, ids, vectors=None) -> bytes:
+    payload = np.ascontiguousarray(ids, dtype="int64").tobytes()
+    if vectors is not None:
+        payload += np.ascontiguousarray(vectors, dtype="float32").tobytes()
+    return _WAL_HEADER.pack(_WAL_MAGIC, op, len(ids), zlib.crc32(payload)) + payload
+
+
+def _replay_wal(wal_path: str, index, tombstones: set, delta=None, delta_ids=None) -> int:
+    """
+    Apply every complete record of a WAL segment to index.
+    With a delta index (read-only partitions, whose index is a mapped
+    snapshot) adds go to delta instead, and removes of snapshot ids are
+    tombstoned.
+    A torn record at the tail (crash mid-append) ends the replay.
+    """
+    with open(wal_path, "rb") as f:
+        data = f.read()
+
+    pos, applied = 0, 0
+    while pos + _WAL_HEADER.size <= len(data):
+        magic, op, n, crc = _WAL_HEADER.unpack_from(data, pos)
+        size = n * 8 + (n * EMBED_DIM * 4 if op == _WAL_ADD else 0)
+        start = pos + _WAL_HEADER.size
+        payload = data[start:start + size]
+        if magic != _WAL_MAGIC or len(payload) != size or zlib.crc32(payload) != crc:
+            print("⚠️ Torn WAL record, stopping replay:", wal_path, "at byte", pos)
+            break
+        ids = np.frombuffer(payload[: n * 8], dtype="int64")
+        if op == _WAL_ADD:
+            vectors = np.frombuffer(payload[n * 8:], dtype="float32").reshape(n, EMBED_DIM)
+            if delta is not None:
+                delta.add_with_ids(vectors, ids)
+                delta_ids.update(ids.tolist())
+            else:
+                index.add_with_ids(vectors, ids)
+        elif op == _WAL_REMOVE and delta is not None:
+            in_delta = [i for i in ids.tolist() if i in delta_ids]
+            if in_delta:
+                delta.remove_ids(faiss.IDSelectorBatch(np.asarray(in_delta, dtype="int64")))
+                delta_ids.difference_update(in_delta)
+            tombstones.update(i for i in ids.tolist() if i not in in_delta)
+        elif op == _WAL_REMOVE:
+            _remove_from_index(index, ids, tombstones)
+        pos = start + size
+        applied += n
+    return applied
+
+
+def _import_json_index(index_path: str, meta_path: str):
+    """
+    Move one (positional index, JSON meta) pair into the MetaStore and re-key
+    its vectors by the new row ids. Returns {username: (vectors, ids)}.
+    """
+    index = faiss.read_index(index_path)
+    ids = import_json_meta(meta_path, chunk_store)
+    with open(meta_path, "r", encoding="utf-8") as f:
+        usernames = [m["username"] for m in json.load(f)]
+
+    n = min(index.ntotal, len(ids))
+    vectors = index.reconstruct_n(0, n) if n else None
+
+    rows_by_user = {}
+    for i in range(n):
+        rows_by_user.setdefault(usernames[i], []).append(i)
+
+    out = {}
+    ids = np.asarray(ids[:n], dtype="int64")
+    for username, rows in rows_by_user.items():
+        out[username] = (vectors[rows], ids[rows])
+    return out
+
+
+def migrate_legacy_layouts():
+    """
+    One-shot conversion of older on-disk layouts into partition directories:
+      - the old global faiss_index.bin / faiss_meta.json
+      - per-user <key>.index / <key>.meta.json partitions
+      - per-user <key>.index files keyed by MetaStore ids
+    Converted files are renamed to *.migrated (or moved) so this runs once.
+    """
+    pairs = []
+    loose = []
+    if os.path.exists(FAISS_INDEX_PATH) and os.path.exists(FAISS_META_PATH):
+        pairs.append((FAISS_INDEX_PATH, FAISS_META_PATH))
+    if os.path.isdir(FAISS_STORE_DIR):
+        for name in sorted(os.listdir(FAISS_STORE_DIR)):
+            path = os.path.join(FAISS_STORE_DIR, name)
+            if name.endswith(".meta.json"):
+                index_path = path[: -len(".meta.json")] + ".index"
+                if os.path.exists(index_path):
+                    pairs.append((index_path, path))
+            elif name.endswith(".index") and not os.path.exists(path[: -len(".index")] + ".meta.json"):
+                loose.append(path)
+
+    for index_path, meta_path in pairs:
+        print("➡️ Migrating JSON metadata:", meta_path)
+        by_user = _import_json_index(index_path, meta_path)
+        for username, (vectors, ids) in by_user.items():
+            part = FaissPartition(username)
+            part.add_with_ids(vectors, ids)
+            part.compact()
+        if index_path == FAISS_INDEX_PATH:
+            os.replace(index_path, index_path + ".migrated")
+        else:
+            os.remove(index_path)
+        os.replace(meta_path, meta_path + ".migrated")
+        print(f"✅ Migrated {meta_path} into {len(by_user)} user partitions")
+
+    for index_path in loose:
+        part_dir = index_path[: -len(".index")]
+        os.makedirs(part_dir, exist_ok=True)
+        os.replace(index_path, os.path.join(part_dir, "snap-0.index"))
+        print("✅ Moved", index_path, "into", part_dir)
+
+
+class FaissPartition:
+    """
+    In-memory copy of one user's sub-index, backed by snapshot + WAL files.
+    Loads once and serves searches from memory; reloads only when the
+    partition directory was changed by another process (name/size stamp),
+    or, when a shared generation counter is given, only after it moves.
+    read_only partitions memory-map their snapshot, keep WAL changes in a
+    private delta index (adds) plus tombstones (removes), and refuse writes.
+    """
+
+    def __init__(self, username: str, read_only: bool = False, generation=None):
+        self.username = username
+        self.dir = _partition_dir(username)
+        self.read_only = read_only
+        self._generation = generation  # multiprocessing.Value bumped by the writer
+        self._seen_generation = None
+        self._lock = threading.RLock()
+        self._compact_lock = threading.Lock()
+        self._index = None
+        self._tombstones = set()  # removed ids still inside an HNSW (or mapped) index
+        self._delta = None        # read_only: vectors added since the snapshot
+        self._delta_ids = set()
+        self._snap_orphans = set()  # read_only: snapshot ids with no MetaStore row
+        self._stamp = None
+        self._snap_seq = 0   # loaded snapshot covers WAL segments <= this
+        self._wal_seq = 1    # segment new records are appended to
+        self.wal_bytes = 0   # WAL bytes not yet folded into a snapshot
+
+    def _snap_path(self, seq: int) -> str:
+        return os.path.join(self.dir, f"snap-{seq}.index")
+
+    def _wal_path(self, seq: int) -> str:
+        return os.path.join(self.dir, f"wal-{seq}.log")
+
+    def _scan(self):
+        """Returns (snapshot seqs, wal seqs) currently on disk, ascending."""
+        try:
+            names = os.listdir(self.dir)
+        except FileNotFoundError:
+            return [], []
+        snaps = sorted(int(m.group(1)) for m in map(_SNAP_RE.match, names) if m)
+        wals = sorted(int(m.group(1)) for m in map(_WAL_RE.match, names) if m)
+        return snaps, wals
+
+    def _disk_stamp(self):
+        stamp = []
+        try:
+            for entry in os.scandir(self.dir):
+                if not entry.name.endswith(".tmp"):
+                    stamp.append((entry.name, entry.stat().st_size))
+        except FileNotFoundError:
+            return None
+        return tuple(sorted(stamp))
+
+    def _ensure_loaded(self):
+        generation = self._generation.value if self._generation is not None else None
+        if self._index is not None and generation is not None and generation == self._seen_generation:
+            return  # nothing published since the last load; skip the directory scan
+        stamp = self._disk_stamp()
+        if self._index is not None and stamp == self._stamp:
+            self._seen_generation = generation
+            return
+        if self._index is not None:
+            print("ℹ️ FAISS partition changed on disk, reloading:", self.dir)
+
+        for attempt in range(3):
+            try:
+                index, delta, delta_ids, tombstones, orphans, snap_seq, pending, wal_bytes = self._load_from_disk()
+                break
+            except FileNotFoundError:
+                if attempt == 2:
+                    raise
+                # the writer compacted between our scan and open; rescan
+                stamp = self._disk_stamp()
+
+        self._index = index
+        self._delta = delta
+        self._delta_ids = delta_ids
+        self._tombstones = tombstones
+        self._snap_seq = snap_seq
+        # never append behind a possibly torn tail: start a fresh segment
+        self._wal_seq = (pending[-1] if pending else snap_seq) + 1
+        self.wal_bytes = wal_bytes
+        self._stamp = stamp
+        self._seen_generation = generation
+        if orphans and not self.read_only:
+            self._log_and_apply(
+                np.asarray(sorted(orphans), dtype="int64"), np.empty(0, dtype="int64"), None
+            )
+
+    def _find_orphans(self, index, tombstones) -> set:
+        """
+        Ids in index whose MetaStore row is gone. MetaStore.replace_doc
+        commits before the WAL record is appended, so a crash in between
+        leaves the old document's vectors behind. Row ids are never reused
+        (AUTOINCREMENT), so a missing row always means a deleted chunk.
+        """
+        ids = _index_ids(index)
+        if not len(ids):
+            return set()
+        live = np.asarray(chunk_store.ids_for_user(self.username), dtype="int64")
+        orphans = set(ids[~np.isin(ids, live)].tolist()) - tombstones
+        if orphans:
+            print(f"⚠️ Dropping {len(orphans)} FAISS vectors with no metadata row from {self.dir}")
+        return orphans
+
+    def _load_from_disk(self):
+        snaps, wals = self._scan()
+        snap_seq = snaps[-1] if snaps else 0
+        pending = [seq for seq in wals if seq > snap_seq]
+        delta, delta_ids = None, set()
+        reused = False
+        if snaps and self.read_only:
+            # keep the mapped snapshot while it's still the published one;
+            # only the (small) WAL delta is rebuilt
+            reused = self._index is not None and self._delta is not None and snap_seq == self._snap_seq
+            if reused:
+                index = self._index
+            else:
+                index = _load_faiss_index(self._snap_path(snap_seq), mmap=True)
+            delta = _new_partition_index()
+        elif snaps:
+            index = _load_faiss_index(self._snap_path(snap_seq))
+        else:
+            index = _new_partition_index()
+        tombstones = set()
+        replayed = 0
+        for seq in pending:
+            replayed += _replay_wal(self._wal_path(seq), index, tombstones, delta, delta_ids)
+        if replayed:
+            print(f"✅ Replayed {replayed} WAL vectors into {self.dir}")
+        wal_bytes = sum(os.path.getsize(self._wal_path(seq)) for seq in pending)
+        if self.read_only:
+            # can't log the removal here: mask the orphans like tombstones
+            orphans = self._snap_orphans if reused else self._find_orphans(index, tombstones)
+            self._snap_orphans = orphans
+            tombstones |= orphans
+            orphans = set()
+        else:
+            orphans = self._find_orphans(index, tombstones)
+        return index, delta, delta_ids, tombstones, orphans, snap_seq, pending, wal_bytes
+
+    def _append_wal(self, record: bytes):
+        os.makedirs(self.dir, exist_ok=True)
+        flags = os.O_WRONLY | os.O_CREAT | os.O_APPEND | getattr(os, "O_BINARY", 0)
+        fd = os.open(self._wal_path(self._wal_seq), flags, 0o644)
+        try:
+            os.write(fd, record)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self.wal_bytes += len(record)
+
+    @property
+    def ntotal(self) -> int:
+        n = self._index.ntotal - len(self._tombstones)
+        return n + self._delta.ntotal if self._delta is not None else n
+
+    def _log_and_apply(self, remove_ids, add_ids, embeddings):
+        """
+        One WAL write holding the remove + add records, then the same change
+        on the live copy. Caller holds self._lock.
+        """
+        if self.read_only:
+            raise RuntimeError(f"FAISS partition {self.username} is read-only in this process")
+        record = b""
+        if len(remove_ids):
+            record += _encode_wal_record(_WAL_REMOVE, remove_ids)
+        if len(add_ids):
+            record += _encode_wal_record(_WAL_ADD, add_ids, embeddings)
+        if not record:
+            return
+        start_ntotal = self.ntotal
+        self._append_wal(record)
+        if len(remove_ids):
+            _remove_from_index(self._index, remove_ids, self._tombstones)
+        if len(add_ids):
+            self._index.add_with_ids(embeddings, add_ids)
+        print(f"✅ FAISS partition {self.username}: {start_ntotal} -> {self.ntotal} vectors")
+        # our own write must not trigger a reload on the next search
+        self._stamp = self._disk_stamp()
+
+    def add_with_ids(self, embeddings, ids):
+        """Log vectors to the WAL, then add them to the live copy."""
+        with self._lock:
+            self._ensure_loaded()
+            self._log_and_apply(np.empty(0, dtype="int64"), ids, embeddings)
+
+    def add(self, embeddings, new_meta):
+        """Append metadata rows + vectors; cost is proportional to new_meta."""
+        ids = np.asarray(chunk_store.add_rows(new_meta), dtype="int64")
+        self.add_with_ids(embeddings, ids)
+
+    def replace_doc(self, doc_path: str, embeddings, new_meta) -> int:
+        """
+        Swap every vector + row of doc_path for the new ones, so re-uploading
+        a document never duplicates its chunks. Returns the removed count.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            old_ids, new_ids = chunk_store.replace_doc(self.username, doc_path, new_meta)
+            self._log_and_apply(
+                np.asarray(old_ids, dtype="int64"),
+                np.asarray(new_ids, dtype="int64"),
+                embeddings,
+            )
+        return len(old_ids)
+
+    def needs_promotion(self) -> bool:
+        return (
+            FAISS_INDEX_TYPE != "flat"
+            and self._index is not None
+            and faiss_index_kind(self._index) == "flat"
+            and self._index.ntotal >= FAISS_PROMOTE_AT
+        )
 
-    print("➡️ Loading existing FAISS index and metadata")
-    index = faiss.read_index(FAISS_INDEX_PATH)
-    with open(FAISS_META_PATH, "r", encoding="utf-8") as f:
-        meta = json.load(f)
-    print(f"✅ Loaded FAISS index with {index.ntotal} vectors, meta size {len(meta)}")
-    return index, meta
+    def compact(self) -> bool:
+        """
+        Fold all WAL segments into a new snapshot, promoting a large Flat
+        partition to FAISS_INDEX_TYPE or purging HNSW tombstones on the way
+        (both rebuild the index). Only the serialization (or vector
+        extraction) runs under the partition lock; training and the file
+        write happen outside it.
+        """
+        if self.read_only:
+            return False
+        with self._compact_lock:
+            with self._lock:
+                self._ensure_loaded()
+                promote = self.needs_promotion()
+                if self.wal_bytes == 0 and not promote:
+                    return False
+                seq = self._wal_seq
+                self._wal_seq += 1  # new appends go to a fresh segment
+                self.wal_bytes = 0
+                if promote:
+                    rebuild_kind = FAISS_INDEX_TYPE
+                elif self._tombstones:
+                    rebuild_kind = faiss_index_kind(self._index)
+                else:
+                    rebuild_kind = None
+                if rebuild_kind:
+                    ids, vectors = _extract_vectors(self._index)
+                    if self._tombstones:
+                        keep = ~np.isin(ids, np.fromiter(self._tombstones, dtype="int64"))
+                        ids, vectors = ids[keep], vectors[keep]
+                else:
+                    data = faiss.serialize_index(self._index)
 
+            if rebuild_kind:
+                print(f"➡️ Rebuilding FAISS partition {self.username} as {rebuild_kind}")
+                new_index = build_faiss_index(rebuild_kind, ids, vectors)
+                data = faiss.serialize_index(new_index)
 
-def _save_faiss_index(index, meta):
-    print("➡️ Saving FAISS index and metadata")
-    faiss.write_index(index, FAISS_INDEX_PATH)
-    with open(FAISS_META_PATH, "w", encoding="utf-8") as f:
-        json.dump(meta, f, ensure_ascii=False)
-    print("✅ Saved FAISS index and metadata")
+            snap_path = self._snap_path(seq)
+            tmp_path = snap_path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data.tobytes())
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, snap_path)
+
+            with self._lock:
+                if rebuild_kind:
+                    # swap in the rebuilt index plus anything logged meanwhile
+                    new_tombstones = set()
+                    for newer in self._scan()[1]:
+                        if newer > seq:
+                            _replay_wal(self._wal_path(newer), new_index, new_tombstones)
+                    self._index = new_index
+                    self._tombstones = new_tombstones
+                snaps, wals = self._scan()
+                for old in snaps:
+                    if old < seq:
+                        os.remove(self._snap_path(old))
+                for old in wals:
+                    if old <= seq:
+                        os.remove(self._wal_path(old))
+                self._snap_seq = seq
+                self._stamp = self._disk_stamp()
+            print(f"✅ Compacted FAISS partition {self.username} into snapshot {seq}")
+            return True
+
+    def export_vectors(self):
+        """(index kind, ids, vectors) of the live partition."""
+        with self._lock:
+            self._ensure_loaded()
+            ids, vectors = _extract_vectors(self._index)
+            if self._tombstones:
+                keep = ~np.isin(ids, np.fromiter(self._tombstones, dtype="int64"))
+                ids, vectors = ids[keep], vectors[keep]
+            if self._delta is not None and self._delta.ntotal:
+                delta_ids, delta_vectors = _extract_vectors(self._delta)
+                ids = np.concatenate([ids, delta_ids])
+                vectors = np.concatenate([vectors, delta_vectors])
+            return faiss_index_kind(self._index), ids, vectors
+
+    def search(self, q, top_k: int, nprobe=None, ef_search=None, allowed=None):
+        """
+        Returns list of (faiss_id, score) for the top_k rows, or [] if empty.
+        nprobe / ef_search tune IVF / HNSW partitions (ignored for Flat).
+        allowed: only these ids are candidates (retrieval filters); applied
+        inside the index search, so the k results all match.
+        """
+        return self.search_batch(q[:1], top_k, nprobe, ef_search, allowed)[0]
+
+    def _reconstruct(self, ids):
+        """
+        (found ids, vectors) for ids, read back from the delta or the main
+        index. Ids not in the partition (e.g. rows whose WAL record isn't
+        written yet) are skipped. Caller holds self._lock.
+        """
+        ids = np.asarray(ids, dtype="int64")
+        if self._delta is not None and self._delta_ids:
+            in_delta = np.isin(ids, np.fromiter(self._delta_ids, dtype="int64"))
+            parts = [(self._index, ids[~in_delta]), (self._delta, ids[in_delta])]
+        else:
+            parts = [(self._index, ids)]
+        found, vectors = [], []
+        for index, part_ids in parts:
+            if not len(part_ids):
+                continue
+            try:
+                vectors.append(index.reconstruct_batch(part_ids))
+                found.append(part_ids)
+            except RuntimeError:
+                for i in part_ids.tolist():
+                    try:
+                        vectors.append(index.reconstruct(i).reshape(1, -1))
+                        found.append(np.asarray([i], dtype="int64"))
+                    except RuntimeError:
+                        continue
+        if not found:
+            return np.empty(0, dtype="int64"), np.empty((0, EMBED_DIM), dtype="float32")
+        return np.concatenate(found), np.concatenate(vectors).astype("float32", copy=False)
+
+    def vectors_for(self, ids):
+        """
+        (len(ids), d) stored vectors of ids, in order; zeros for ids that
+        are no longer in the partition.
+        """
+        ids = np.asarray(ids, dtype="int64")
+        out = np.zeros((len(ids), EMBED_DIM), dtype="float32")
+        with self._lock:
+            self._ensure_loaded()
+            found, vectors = self._reconstruct(ids)
+        row_of = {int(i): row for row, i in enumerate(found.tolist())}
+        for pos, i in enumerate(ids.tolist()):
+            if i in row_of:
+                out[pos] = vectors[row_of[i]]
+        return out
+
+    def _exact_search(self, q, k: int, ids):
+        """Brute-force top k of q over ids, in blocks of FAISS_FILTER_EXACT_MAX."""
+        best_ids = np.empty((q.shape[0], 0), dtype="int64")
+        best_scores = np.empty((q.shape[0], 0), dtype="float32")
+        for start in range(0, len(ids), FAISS_FILTER_EXACT_MAX):
+            block_ids, vectors = self._reconstruct(ids[start:start + FAISS_FILTER_EXACT_MAX])
+            if not len(block_ids):
+                continue
+            best_ids = np.concatenate([best_ids, np.broadcast_to(block_ids, (q.shape[0], len(block_ids)))], axis=1)
+            best_scores = np.concatenate([best_scores, q @ vectors.T], axis=1)
+            if best_ids.shape[1] > k:
+                top = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_ids = np.take_along_axis(best_ids, top, axis=1)
+                best_scores = np.take_along_axis(best_scores, top, axis=1)
+        order = np.argsort(-best_scores, axis=1)
+        best_ids = np.take_along_axis(best_ids, order, axis=1)
+        best_scores = np.take_along_axis(best_scores, order, axis=1)
+        return [
+            [(int(i), float(d)) for i, d in zip(row_ids, row_d)]
+            for row_ids, row_d in zip(best_ids.tolist(), best_scores.tolist())
+        ]
+
+    def search_batch(self, q, top_k: int, nprobe=None, ef_search=None, allowed=None):
+        """
+        search() for every row of q (n, d) in one index call.
+        Returns one [(faiss_id, score)] list per row.
+        Searches hold the lock so they never race with an in-place add.
+        Narrow filters (and any filter on a PQ partition, which takes no
+        selector) are scored exactly; wider ones widen efSearch / nprobe.
+        """
+        with self._lock:
+            self._ensure_loaded()
+            if allowed is not None:
+                allowed = np.asarray(allowed, dtype="int64")
+                if self._tombstones:
+                    allowed = allowed[~np.isin(allowed, np.fromiter(self._tombstones, dtype="int64"))]
+            k = min(top_k, self.ntotal if allowed is None else len(allowed))
+            if k <= 0:
+                return [[] for _ in range(q.shape[0])]
+            if allowed is not None and (
+                len(allowed) <= FAISS_FILTER_EXACT_MAX or faiss_index_kind(self._index) == "pq"
+            ):
+                return self._exact_search(q, k, allowed)
+            if allowed is not None:
+                narrow = self.ntotal / max(len(allowed), 1)
+                ef_search = min(int((ef_search or FAISS_EF_SEARCH) * narrow), FAISS_FILTER_MAX_EF)
+                nprobe = int((nprobe or FAISS_NPROBE) * narrow)  # faiss caps it at nlist
+            results = _search_index(self._index, q, k, nprobe, ef_search, allowed, self._tombstones)
+            if self._delta is not None and self._delta.ntotal:
+                delta_results = _search_index(self._delta, q, k, None, None, allowed, None)
+                results = [
+                    sorted(a + b, key=lambda hit: hit[1], reverse=True)[:k]
+                    for a, b in zip(results, delta_results)
+                ]
+            short = [row for row, hits in enumerate(results) if len(hits) < k]
+            if allowed is not None and short:
+                print(f"ℹ️ Filtered FAISS search came back short for {len(short)} queries, scoring exactly")
+                for row, hits in zip(short, self._exact_search(q[short], k, allowed)):
+                    results[row] = hits
+        return results
+
+
+class FaissIndexManager:
+    """
+    Process-wide registry of per-user partitions plus the background
+    compactor. Older layouts are migrated on first use.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._partitions = {}
+        self._migrated = False
+        self._compact_wakeup = threading.Event()
+        self._compactor = None
+        self.read_only = False
+        self._generation = None
+
+    def share(self, generation, read_only: bool):
+        """
+        Switch to pre-fork serving (serve.py). generation is a
+        multiprocessing.Value shared by every process: the writer bumps it
+        after publishing a snapshot, readers remap when it moves.
+        Drops loaded partitions so they reopen in the new mode.
+        """
+        with self._lock:
+            self._generation = generation
+            self.read_only = read_only
+            self._partitions = {}
+
+    def preload(self):
+        """Open every user's partition now (before forking, in serve.py)."""
+        for username in chunk_store.usernames():
+            part = self.partition(username)
+            with part._lock:
+                part._ensure_loaded()
+        print(f"✅ Preloaded {len(self._partitions)} FAISS partitions")
+
+    def partition(self, username: str) -> FaissPartition:
+        with self._lock:
+            if not self._migrated:
+                migrate_legacy_layouts()
+                self._migrated = True
+            part = self._partitions.get(username)
+            if part is None:
+                part = FaissPartition(username, self.read_only, self._generation)
+                self._partitions[username] = part
+            return part
+
+    def _publish(self):
+        """serve.py writer: tell read-only workers the partitions changed."""
+        if self._generation is not None:
+            with self._generation.get_lock():
+                self._generation.value += 1
+
+    def schedule_compaction(self, part: FaissPartition):
+        """
+        Publish the write (readers replay the new WAL record), start the
+        compactor lazily and wake it now if the WAL is large.
+        """
+        self._publish()
+        with self._lock:
+            if self._compactor is None:
+                self._compactor = threading.Thread(
+                    target=self._compact_loop, name="faiss-compactor", daemon=True
+                )
+                self._compactor.start()
+        if part.wal_bytes >= FAISS_COMPACT_WAL_BYTES:
+            self._compact_wakeup.set()
+
+    def _compact_loop(self):
+        while True:
+            self._compact_wakeup.wait(timeout=FAISS_COMPACT_INTERVAL_S)
+            self._compact_wakeup.clear()
+            with self._lock:
+                parts = list(self._partitions.values())
+            for part in parts:
+                if part.wal_bytes == 0 and not part.needs_promotion():
+                    continue
+                try:
+                    if part.compact():
+                        self._publish()
+                except Exception as e:
+                    print("FAISS COMPACTION ERROR for", part.username, ":", e)
+
+
+index_manager = FaissIndexManager()
 
 
 def build_or_update_faiss_index(username: str, title: str, path_in_bucket: str, chunks, embeddings):
     """
-    Add new chunks + embeddings to the FAISS index and metadata.
+    Add new chunks + embeddings to the user's FAISS partition and metadata.
     embeddings: numpy array (n, d)
     """
     print("➡️ build_or_update_faiss_index: chunks =", len(chunks))
@@ -152,10 +1358,6 @@ def build_or_update_faiss_index(username: str, title: str, path_in_bucket: str,
     # Normalize embeddings for cosine similarity (inner product)
     faiss.normalize_L2(embeddings)
 
-    index, meta = _load_faiss_index()
-
-    start_ntotal = index.ntotal
-
     # Build metadata entries
     new_meta = []
     for idx, chunk in enumerate(chunks):
@@ -164,84 +1366,427 @@ def build_or_update_faiss_index(username: str, title: str, path_in_bucket: str,
             "username": username,
             "folder_title": title,
             "doc_path": path_in_bucket,
+            "root_type": root_type_of(path_in_bucket),
             "section_title": chunk["title"],
             "chunk_index": idx,
             "content": chunk["content"],
         })
 
-    # Add to FAISS
-    index.add(embeddings)
-    meta.extend(new_meta)
+    # re-ingesting an existing doc_path replaces its old chunks
+    part = index_manager.partition(username)
+    removed = part.replace_doc(path_in_bucket, embeddings, new_meta)
+    if removed:
+        print(f"♻️ Replaced {removed} old chunks of {path_in_bucket}")
+    index_manager.schedule_compaction(part)
 
-    print(f"✅ FAISS index updated: {start_ntotal} -> {index.ntotal} vectors")
-    _save_faiss_index(index, meta)
-
-def search_faiss(username: str, folder_title: str | None, query_embedding, top_k: int = 5):
+def retrieval_filters(folder_title: str | None = None, doc_path: str | None = None,
+                      root_type: str | None = None):
     """
-    Search the FAISS index for nearest chunks.
-    query_embedding: numpy array shape (d,)
-    Returns list of metadata dicts for top_k results, filtered by user.
+    {field: value} of the filters that are set, or None. folder_title is
+    matched the way uploads store it (spaces -> underscores).
     """
-    print("➡️ search_faiss for user:", username, "folder:", folder_title)
+    filters = {}
+    if folder_title and folder_title.strip():
+        filters["folder_title"] = folder_title.strip().replace(" ", "_")
+    if doc_path:
+        filters["doc_path"] = doc_path
+    if root_type:
+        filters["root_type"] = root_type
+    return filters or None
 
-    if not os.path.exists(FAISS_INDEX_PATH) or not os.path.exists(FAISS_META_PATH):
-        print("⚠️ No FAISS index/meta found.")
-        return []
 
-    index, meta = _load_faiss_index()
-    if index.ntotal == 0:
-        print("⚠️ FAISS index empty.")
-        return []
+def search_faiss(username: str, folder_title: str | None, query_embedding, top_k: int = 5,
+                 nprobe: int | None = None, ef_search: int | None = None,
+                 doc_path: str | None = None, root_type: str | None = None):
+    """
+    Search the user's FAISS partition for nearest chunks.
+    query_embedding: numpy array shape (d,)
+    folder_title / doc_path / root_type: optional filters, applied inside
+    the index search via an ID selector.
+    nprobe / ef_search: optional IVF / HNSW recall-vs-speed knobs.
+    Returns list of metadata dicts for top_k results (fewer only if the user
+    has fewer matching chunks).
+    """
+    filters = retrieval_filters(folder_title, doc_path, root_type)
+    print("➡️ search_faiss for user:", username, "filters:", filters)
 
-    import numpy as np
     q = query_embedding.astype("float32")
     q = q.reshape(1, -1)
     faiss.normalize_L2(q)
 
-    distances, indices = index.search(q, top_k)
-    idxs = indices[0].tolist()
-    ds = distances[0].tolist()
+    allowed = chunk_store.ids_matching(username, filters) if filters else None
+    hits = index_manager.partition(username).search(
+        q, top_k, nprobe=nprobe, ef_search=ef_search, allowed=allowed
+    )
+    if not hits:
+        print("⚠️ No FAISS vectors for user:", username, "filters:", filters)
+        return []
 
+    rows = chunk_store.fetch([i for i, _ in hits])
     results = []
-    for rank, (i, d) in enumerate(zip(idxs, ds)):
-        if i < 0 or i >= len(meta):
+    for i, d in hits:
+        m = rows.get(i)
+        if m is None:
             continue
-        m = meta[i]
-        if m["username"] != username:
+        m["score"] = d
+        results.append(m)
+
+    print("✅ search_faiss returned", len(results), "results")
+    return results
+
+def search_faiss_batch(username: str, query_embeddings, top_k: int = 5, filters=None,
+                       nprobe: int | None = None, ef_search: int | None = None):
+    """
+    search_faiss for many queries at once.
+    query_embeddings: numpy array (n, d)
+    filters: None, one retrieval_filters() dict for every query, or a list
+    of n of them. Queries sharing a filter go to the index in one search
+    call, so the whole batch costs one call per distinct filter.
+    Returns n lists of metadata dicts, in query order.
+    """
+    q = np.array(query_embeddings, dtype="float32").reshape(-1, EMBED_DIM)
+    faiss.normalize_L2(q)
+    n = q.shape[0]
+    if filters is None or isinstance(filters, dict):
+        filters = [filters] * n
+    if len(filters) != n:
+        raise ValueError(f"search_faiss_batch: {n} queries but {len(filters)} filters")
+
+    groups = {}  # filter key -> query rows
+    for row, f in enumerate(filters):
+        groups.setdefault(tuple(sorted((f or {}).items())), []).append(row)
+    print(f"➡️ search_faiss_batch for user: {username} queries: {n} filter groups: {len(groups)}")
+
+    part = index_manager.partition(username)
+    hits = [None] * n
+    for key, rows in groups.items():
+        f = dict(key)
+        allowed = chunk_store.ids_matching(username, f) if f else None
+        for row, row_hits in zip(rows, part.search_batch(
+            q[rows], top_k, nprobe=nprobe, ef_search=ef_search, allowed=allowed
+        )):
+            hits[row] = row_hits
+
+    meta = chunk_store.fetch({i for row_hits in hits for i, _ in row_hits})
+    results = []
+    for row_hits in hits:
+        out = []
+        for i, d in row_hits:
+            m = meta.get(i)
+            if m is not None:
+                out.append({**m, "score": d})
+        results.append(out)
+
+    print("✅ search_faiss_batch returned", sum(len(r) for r in results), "results")
+    return results
+
+# -------------------------
+# 5) Lexical (BM25) + hybrid retrieval
+# -------------------------
+# Exact terms (acronyms, formula names, section numbers) are matched by the
+# SQLite FTS5 index in meta_store; hybrid mode fuses its ranking with
+# FAISS's by reciprocal-rank fusion: score = sum of 1 / (RRF_K + rank).
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "hybrid")  # hybrid | vector | bm25
+RRF_K = 60
+HYBRID_CANDIDATES = 30  # hits taken from each retriever before fusing
+
+
+def search_bm25(username: str, query: str, top_k: int = 5, filters=None):
+    """
+    BM25 hits for query in the user's chunks, best first ("bm25" = FTS5 score).
+    filters: see retrieval_filters.
+    """
+    started = time.perf_counter()
+    hits = chunk_store.lexical_search(username, query, top_k, filters=filters)
+    rows = chunk_store.fetch([i for i, _ in hits])
+    results = []
+    for i, score in hits:
+        m = rows.get(i)
+        if m is None:
             continue
-        # folder_title no longer used
-        m_copy = dict(m)
-        m_copy["score"] = float(d)
-        results.append(m_copy)
+        m["bm25"] = score
+        results.append(m)
+    print(f"✅ search_bm25 returned {len(results)} results in "
+          f"{(time.perf_counter() - started) * 1000:.1f} ms")
+    return results
+
+
+# Optional cross-encoder rerank: over-fetch RERANK_CANDIDATES hits and
+# re-score (query, chunk) pairs jointly. Scoring runs in small batches
+# against a per-request budget (the model load, done by warm_up, doesn't
+# count); once the next batch would overrun it, the pairs scored so far are
+# reordered and the rest follow in the retriever's order.
+RERANK_ENABLED = os.getenv("RERANK", "0") == "1"
+RERANK_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANK_CANDIDATES = 50
+RERANK_BATCH_SIZE = 8  # small, so the budget is overrun by at most one short batch
+RERANK_BUDGET_MS = float(os.getenv("RERANK_BUDGET_MS", "400"))
+
+rerank_model = None
+_rerank_model_lock = threading.Lock()
+_rerank_stats_lock = threading.Lock()
+_rerank_stats = {"calls": 0, "fallbacks": 0, "pairs": 0, "seconds": 0.0}
+
+
+def get_rerank_model():
+    global rerank_model
+    if rerank_model is None:
+        with _rerank_model_lock:
+            if rerank_model is None:
+                from sentence_transformers import CrossEncoder
+                print(f"🧠 Loading rerank model: {RERANK_MODEL_NAME}")
+                rerank_model = CrossEncoder(RERANK_MODEL_NAME, max_length=256)
+    return rerank_model
+
+
+def rerank(query: str, candidates, top_k: int, budget_ms: float = RERANK_BUDGET_MS):
+    """
+    Best top_k of candidates by cross-encoder score ("rerank_score").
+    Candidates not scored when the budget runs out (or the model fails)
+    keep retriever order after the scored ones.
+    """
+    if len(candidates) <= 1:
+        return candidates[:top_k]
+    scores = []
+    fallback = False
+    started = time.perf_counter()
+    try:
+        model = get_rerank_model()
+        started = time.perf_counter()  # budget covers scoring, not the first load
+        deadline = started + budget_ms / 1000.0
+        for start in range(0, len(candidates), RERANK_BATCH_SIZE):
+            now = time.perf_counter()
+            per_batch = (now - started) / (start // RERANK_BATCH_SIZE) if start else 0.0
+            if now + per_batch > deadline:
+                fallback = True
+                break
+            batch = candidates[start:start + RERANK_BATCH_SIZE]
+            pairs = [(query, f"{m.get('section_title') or ''}\n{m['content']}") for m in batch]
+            scores.extend(float(x) for x in model.predict(
+                pairs, batch_size=RERANK_BATCH_SIZE, show_progress_bar=False
+            ))
+    except Exception as e:
+        print("RERANK ERROR:", e)
+        fallback = True
+
+    elapsed = time.perf_counter() - started
+    with _rerank_stats_lock:
+        _rerank_stats["calls"] += 1
+        _rerank_stats["fallbacks"] += fallback
+        _rerank_stats["pairs"] += len(scores)
+        _rerank_stats["seconds"] += elapsed
+    for m, score in zip(candidates, scores):
+        m["rerank_score"] = score
+    scored = sorted(candidates[:len(scores)], key=lambda m: m["rerank_score"], reverse=True)
+    if fallback:
+        print(f"⚠️ rerank: budget {budget_ms:.0f} ms exceeded or failed after "
+              f"{len(scores)}/{len(candidates)} candidates, rest in retriever order")
+    else:
+        print(f"✅ rerank: {len(candidates)} candidates in {elapsed * 1000:.0f} ms")
+    return (scored + candidates[len(scores):])[:top_k]
+
+
+def rerank_stats():
+    with _rerank_stats_lock:
+        st = dict(_rerank_stats)
+    st["enabled"] = RERANK_ENABLED
+    st["avg_ms"] = round(st.pop("seconds") * 1000 / st["calls"], 1) if st["calls"] else 0.0
+    return st
+
+
+def search_hybrid(username: str, folder_title: str | None, query: str, top_k: int = 5,
+                  query_embedding=None, mode: str | None = None, rerank_hits: bool | None = None,
+                  doc_path: str | None = None, root_type: str | None = None):
+    """
+    Retrieve top_k chunks for query with RETRIEVAL_MODE (or mode):
+      vector  FAISS only (search_faiss)
+      bm25    lexical only (search_bm25)
+      hybrid  both, fused by reciprocal rank; "score" is the fused score
+    query_embedding: pass one in to embed something other than query.
+    folder_title / doc_path / root_type: optional filters (both retrievers).
+    rerank_hits: cross-encoder rerank of RERANK_CANDIDATES hits
+    (default: RERANK_ENABLED).
+    """
+    if rerank_hits is None:
+        rerank_hits = RERANK_ENABLED
+    if rerank_hits:
+        candidates = search_hybrid(
+            username, folder_title, query, max(top_k, RERANK_CANDIDATES),
+            query_embedding=query_embedding, mode=mode, rerank_hits=False,
+            doc_path=doc_path, root_type=root_type,
+        )
+        return rerank(query, candidates, top_k)
+
+    mode = mode or RETRIEVAL_MODE
+    filters = retrieval_filters(folder_title, doc_path, root_type)
+    if mode == "bm25":
+        return search_bm25(username, query, top_k, filters=filters)
 
-    print("✅ search_faiss returned", len(results), "results after filtering")
+    if query_embedding is None:
+        query_embedding = embed_query(query)
+    if mode == "vector":
+        return search_faiss(username, folder_title, query_embedding, top_k=top_k,
+                            doc_path=doc_path, root_type=root_type)
+
+    n = max(top_k, HYBRID_CANDIDATES)
+    vector_hits = search_faiss(username, folder_title, query_embedding, top_k=n,
+                               doc_path=doc_path, root_type=root_type)
+    lexical_hits = search_bm25(username, query, n, filters=filters)
+
+    fused = {}
+    for hits in (vector_hits, lexical_hits):
+        for rank, m in enumerate(hits):
+            entry = fused.setdefault(m["faiss_id"], {**m, "rrf": 0.0})
+            entry["rrf"] += 1.0 / (RRF_K + rank + 1)
+            if "bm25" in m:
+                entry["bm25"] = m["bm25"]
+
+    results = sorted(fused.values(), key=lambda m: m["rrf"], reverse=True)[:top_k]
+    for m in results:
+        if "score" in m:
+            m["vector_score"] = m["score"]
+        m["score"] = m.pop("rrf")
+    print(f"✅ search_hybrid: {len(vector_hits)} vector + {len(lexical_hits)} bm25 -> {len(results)}")
     return results
 
+
+def search_multi_query(username: str, queries, top_k: int = 10, folder_title: str | None = None,
+                       doc_path: str | None = None, root_type: str | None = None,
+                       lexical_query: str | None = None):
+    """
+    Retrieve for several focused queries at once: one embedding batch, one
+    batched FAISS call (search_faiss_batch), plus BM25 for lexical_query
+    unless RETRIEVAL_MODE is "vector". The per-query lists are merged by
+    reciprocal rank, so a chunk found by several queries ranks higher and
+    appears once. Returns top_k hits, "score" = fused score.
+    """
+    queries = [q for q in dict.fromkeys(q.strip() for q in queries) if q]
+    if not queries:
+        return []
+    filters = retrieval_filters(folder_title, doc_path, root_type)
+    n = max(top_k, HYBRID_CANDIDATES // 2)
+
+    ranked_lists = search_faiss_batch(username, embed_queries(queries), n, filters)
+    if lexical_query and RETRIEVAL_MODE != "vector":
+        ranked_lists.append(search_bm25(username, lexical_query, n, filters=filters))
+
+    fused = {}
+    for hits in ranked_lists:
+        for rank, m in enumerate(hits):
+            entry = fused.setdefault(m["faiss_id"], {**m, "rrf": 0.0})
+            entry["rrf"] += 1.0 / (RRF_K + rank + 1)
+
+    results = sorted(fused.values(), key=lambda m: m["rrf"], reverse=True)[:top_k]
+    for m in results:
+        if "score" in m:
+            m["vector_score"] = m["score"]
+        m["score"] = m.pop("rrf")
+    print(f"✅ search_multi_query: {len(queries)} queries -> {len(fused)} unique chunks -> {len(results)}")
+    return results
+
+
+def build_context(hits, query_embedding=None, token_budget: int = CONTEXT_TOKEN_BUDGET) -> str:
+    """
+    "Context:" text for an LLM prompt from retrieval hits: near-duplicates
+    dropped, MMR-ordered, packed into token_budget (context_pack).
+    Chunk vectors are read back from the users' FAISS partitions by
+    faiss_id, so nothing is embedded (or written) on the request path.
+    """
+    if not hits:
+        return ""
+    vectors = np.zeros((len(hits), EMBED_DIM), dtype="float32")
+    by_user = {}
+    for pos, h in enumerate(hits):
+        by_user.setdefault(h["username"], []).append(pos)
+    for username, positions in by_user.items():
+        ids = [hits[pos]["faiss_id"] for pos in positions]
+        vectors[positions] = index_manager.partition(username).vectors_for(ids)
+    context, _ = pack_context(
+        hits, query_embedding, vectors,
+        getattr(get_embed_model(), "tokenizer", None), token_budget,
+    )
+    return context
+
+
 # -------------------------
-# 5) One-shot ingestion helper (for testing)
+# 6) Ingestion pipeline + background job queue
 # -------------------------
-def ingest_single_file(username: str, title: str, path_in_bucket: str):
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+
+
+def ingest_single_file(username: str, title: str, path_in_bucket: str, progress=None,
+                       local_path: str | None = None):
     """
     Full pipeline for a single file:
     Supabase -> temp file -> Unstructured -> local embeddings -> FAISS index.
+    local_path: a local copy of the object (spooled upload) to use instead
+    of downloading it again.
+    progress(stage) is called after each stage (see INGEST_STAGES).
     """
+    progress = progress or (lambda stage: None)
     print("\n==============================")
     print("🚀 ingest_single_file START")
     print("user:", username, "title:", title, "path:", path_in_bucket)
 
-    local_path = download_file_from_supabase(path_in_bucket)
-    chunks = partition_and_chunk(local_path, title)
+    if local_path is not None:
+        progress("downloaded")
+        chunks = partition_and_chunk(local_path, title)
+    else:
+        with download_file_from_supabase(path_in_bucket) as tmp_path:
+            progress("downloaded")
+            chunks = partition_and_chunk(tmp_path, title)
+    progress("partitioned")
     if not chunks:
         print("❌ No chunks produced.")
         return
 
     texts = [c["content"] for c in chunks]
-    embeddings = embed_local(texts)
+    embeddings = embed_chunks(texts)
+    progress("embedded")
     build_or_update_faiss_index(username, title, path_in_bucket, chunks, embeddings)
+    progress("indexed")
 
     print("✅ ingest_single_file DONE")
 
 
+ingest_jobs = IngestQueue()
+ingest_workers = IngestWorkers(
+    ingest_jobs,
+    lambda job, set_stage: ingest_single_file(
+        job["username"], job["title"], job["path_in_bucket"],
+        progress=set_stage, local_path=job["local_path"],
+    ),
+    INGEST_WORKERS,
+)
+
+
+def enqueue_ingest(username: str, title: str, path_in_bucket: str, data: bytes | None = None) -> str:
+    """
+    Queue a file for background ingestion; returns the job id.
+    data: the uploaded bytes, spooled locally so the worker skips the download.
+    """
+    return ingest_jobs.enqueue(username, title, path_in_bucket, data=data)
+
+
+def start_ingest_workers():
+    """Start draining the queue in this process (the index writer)."""
+    ingest_workers.start()
+
+
+def start_background():
+    """
+    Warm-up plus, unless this process only reads the index (serve.py HTTP
+    workers), the ingest workers. Safe to call on every request.
+    """
+    start_warm_up()
+    if not index_manager.read_only:
+        start_ingest_workers()
+
+
+def ingest_status(username: str, job_ids=None):
+    return ingest_jobs.jobs(username, job_ids)
+
+
 if __name__ == "__main__":
     # Example manual test
     ingest_single_file(
@@ -0,0 +1,116 @@
+import os
+import sys
+import signal
+import socket
+import threading
+import multiprocessing
+
+# ====== Pre-fork production server ======
+# python serve.py [workers] [port]
+#
+# The master imports app.py, warms the embedding model and memory-maps every
+# user's FAISS snapshot, then forks. Children share those pages copy-on-write
+# (model weights) or through the page cache (mmapped snapshots) instead of
+# each loading their own copy.
+#
+#   HTTP workers  serve app.py on one shared listening socket; read-only
+#                 index, uploads only enqueue ingest jobs
+#   writer        the single process that drains the ingest queue and
+#                 publishes new snapshots, bumping a shared generation
+#                 counter so HTTP workers remap on their next search
+#
+# Unix only (os.fork); elsewhere it falls back to a single app.run process.
+SERVE_HOST = os.getenv("SERVE_HOST", "0.0.0.0")
+SERVE_PORT = int(os.getenv("SERVE_PORT", "5000"))
+SERVE_WORKERS = int(os.getenv("SERVE_WORKERS", "2"))
+
+
+def run_http_worker(app, sock):
+    from werkzeug.serving import make_server
+
+    server = make_server(SERVE_HOST, sock.getsockname()[1], app, threaded=True, fd=sock.fileno())
+    print(f"🚀 HTTP worker {os.getpid()} serving")
+    server.serve_forever()
+
+
+def run_writer(generation):
+    import rag_local
+
+    rag_local.index_manager.share(generation, read_only=False)
+    print(f"🚀 Index writer {os.getpid()} waiting for ingest jobs")
+    rag_local.start_ingest_workers()
+    threading.Event().wait()
+
+
+def spawn(target, *args) -> int:
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        try:
+            target(*args)
+        finally:
+            os._exit(1)
+    return pid
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else SERVE_WORKERS
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else SERVE_PORT
+
+    from app import app
+    import rag_local
+
+    # background work is started explicitly below, per process role
+    app.config["RAG_AUTOSTART"] = False
+
+    if not hasattr(os, "fork"):
+        print("⚠️ os.fork not available; running a single process instead")
+        rag_local.start_warm_up()
+        rag_local.start_ingest_workers()
+        app.run(host=SERVE_HOST, port=port)
+        return
+
+    rag_local.warm_up()
+    ctx = multiprocessing.get_context("fork")
+    generation = ctx.Value("q", 0)
+    rag_local.index_manager.share(generation, read_only=True)
+    rag_local.index_manager.preload()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((SERVE_HOST, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+    print(f"✅ Listening on {SERVE_HOST}:{port} with {workers} HTTP workers + 1 writer")
+
+    roles = {spawn(run_writer, generation): "writer"}
+    for _ in range(workers):
+        roles[spawn(run_http_worker, app, sock)] = "http"
+
+    def shutdown(signum, frame):
+        for pid in roles:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    # restart whatever dies; children re-fork from the already warm master
+    while True:
+        pid, status = os.wait()
+        role = roles.pop(pid, None)
+        if role is None:
+            continue
+        print(f"⚠️ {role} process {pid} exited ({status}), restarting")
+        if role == "writer":
+            roles[spawn(run_writer, generation)] = "writer"
+        else:
+            roles[spawn(run_http_worker, app, sock)] = "http"
+
+
+if __name__ == "__main__":
+    main()
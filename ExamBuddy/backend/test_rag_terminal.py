@@ -2,7 +2,7 @@ import os
 import sys
 from typing import List, Dict
 
-from rag_local import embed_local, search_faiss
+from rag_local import embed_query, search_hybrid, build_context
 
 from langchain_groq import ChatGroq
 
@@ -33,13 +33,9 @@ llm = ChatGroq(
 )
 
 # ====== Core RAG + LLM ======
-def build_context_from_results(results: List[Dict]) -> str:
-    blocks = []
-    for r in results:
-        blocks.append(
-            f"[{r['folder_title']} / {r['section_title']}] {r['content']}"
-        )
-    return "\n\n".join(blocks)
+def build_context_from_results(results: List[Dict], query_embedding=None) -> str:
+    # same dedup / MMR / token-budget packing as the app's chat route
+    return build_context(results, query_embedding)
 
 def answer_with_rag_and_history(
     username: str,
@@ -48,10 +44,11 @@ def answer_with_rag_and_history(
     history: List[Dict[str, str]],
 ) -> str:
     # 1) embed question
-    q_emb = embed_local([question])[0]
+    q_emb = embed_query(question)
 
     # 2) retrieve chunks
-    results = search_faiss(username, topic, q_emb, top_k=5)
+    # topic is free text, not a folder name: search all of the user's chunks
+    results = search_hybrid(username, None, question, top_k=5, query_embedding=q_emb)
 
     if not results:
         # No context -> let LLM answer freely (still as  PrepIQ)
@@ -68,7 +65,7 @@ def answer_with_rag_and_history(
 
 
     # 3) build context string
-    context = build_context_from_results(results)
+    context = build_context_from_results(results, q_emb)
 
     # 4) build LangChain messages with history + context
     messages = [
@@ -116,14 +113,14 @@ def main():
 
         # 1) embed + retrieve to show chunks
         try:
-            q_emb = embed_local([q])[0]
-            results = search_faiss(username, topic, q_emb, top_k=5)
+            q_emb = embed_query(q)
+            results = search_hybrid(username, None, q, top_k=5, query_embedding=q_emb)
         except Exception as e:
             print("[Error during retrieval]", e)
             continue
 
         if not results:
-            print("\n[No relevant chunks retrieved from FAISS for this question.]")
+            print("\n[No relevant chunks retrieved for this question.]")
         else:
             print(f"\n[Top {len(results)} retrieved chunks:]")
             for i, r in enumerate(results, start=1):
@@ -0,0 +1,45 @@
+# backend/test_readiness.py
+# python -m pytest -q test_readiness.py
+
+import threading
+import time
+import importlib
+
+
+class SlowModel:
+    """Stand-in embedding model whose load blocks until release is set."""
+
+    def __init__(self, loading, release):
+        loading.set()
+        release.wait(timeout=10)
+
+    def encode(self, texts, **kwargs):
+        return [[0.0] for _ in texts]
+
+
+def test_warm_up_hook_never_waits_on_model_load(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # MetaStore / caches are created under cwd
+    rag_local = importlib.import_module("rag_local")
+
+    loading, release = threading.Event(), threading.Event()
+    monkeypatch.setattr(rag_local, "embed_model", None)
+    monkeypatch.setattr(rag_local, "_ready", threading.Event())
+    monkeypatch.setattr(rag_local, "_warm_up_started", threading.Event())
+    monkeypatch.setattr(rag_local, "RERANK_ENABLED", False)
+    monkeypatch.setattr(rag_local, "load_embed_model", lambda: SlowModel(loading, release))
+
+    try:
+        rag_local.start_warm_up()  # first request: starts the background load
+        assert loading.wait(timeout=5)
+
+        started = time.perf_counter()
+        rag_local.start_warm_up()  # second request, model still loading
+        assert time.perf_counter() - started < 0.1
+        assert not rag_local.is_ready()
+    finally:
+        release.set()
+
+    deadline = time.time() + 5
+    while not rag_local.is_ready() and time.time() < deadline:
+        time.sleep(0.01)
+    assert rag_local.is_ready()